@@ -3,28 +3,33 @@
 # @Time   : 2023/10/30 15:33
 # @Author : huangkewei
 
+import json
+import asyncio
 
 from loguru import logger
-from threading import Condition
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
 
-from master import q_thread, Task
-from pipe import create_process_pipe
-from models import APIRequestModel
-from exception import TimeoutException
+from master import master, render_master, master_start
+from models import PageRenderRequestModel, APIRequestModel, BatchRequestModel, BatchFormat, JobRequestModel, JobResponseModel, ContentEncoding
+from compression import negotiate_encoding, compress, iter_chunks
+from batch import stream_batch
+from jobs import JobStore
+from exception import RequestException
 
-from env import OPEN_SENTRY, SENTRY_NSD
+from env import OPEN_SENTRY, SENTRY_NSD, SENTRY_TRACES_SAMPLE_RATE, BATCH_MAX_ITEMS
 
 if OPEN_SENTRY:
     import sentry_sdk
 
     sentry_sdk.init(
         dsn=SENTRY_NSD,
-        traces_sample_rate=1.0,
+        traces_sample_rate=SENTRY_TRACES_SAMPLE_RATE,
     )
 
 app = FastAPI()
+job_store = JobStore(master.execute)
 
 
 @app.exception_handler(HTTPException)
@@ -38,29 +43,116 @@ def ping():
     return "PONG"
 
 
+@app.get("/ready")
+async def ready():
+    # 没有足够的可用子进程或内存不足暂停分配时返回503，健康检查据此判断容器是否可接收流量
+    # 在事件循环中读取子进程池状态，与master同线程
+    if not master.is_ready() or not render_master.is_ready():
+        return JSONResponse(status_code=503, content={"ready": False})
+    return {"ready": True}
+
+
+@app.get("/metrics")
+async def metrics():
+    # 在事件循环中读取子进程池状态，与master同线程
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+@app.on_event("startup")
+async def startup():
+    # master 运行在 uvicorn 的事件循环中
+    master_start()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await job_store.close()
+    await master.close()
+    if render_master is not master:
+        await render_master.close()
+
+
 @app.post("/get_content")
 @app.post("/get_cookies")
-def get_content(api_req: APIRequestModel):
-    # 创建任务
-    p_pipe, c_pipe = create_process_pipe()
-    cond = Condition()
-    task = Task(pipe=c_pipe, cond=cond, flag=0)
-    q_thread.put(task)
-
-    # 发送具体任务
-    task.cond.acquire()
-    p_pipe.send(api_req)
-    task.cond.notify()
-    task.flag = 1
-    task.cond.release()
+async def get_content(api_req: APIRequestModel):
     logger.info('发送具体任务')
+    data = await master.execute(api_req)
+
+    logger.info('任务执行成功')
 
-    data = p_pipe.recv(int(api_req.gotoOptions.timeout / 1000))
-    if data is None:
-        raise TimeoutException("请求超时！")
-    elif isinstance(data, HTTPException):
-        raise data
+    return data
+
+
+@app.post("/get_content_raw")
+async def get_content_raw(api_req: APIRequestModel, request: Request):
+    """
+    直接返回 text/html 页面内容，按 Accept-Encoding 压缩并分块返回；cookies 以json格式放在 X-Cookies 响应头
+    """
+    encoding = negotiate_encoding(request.headers.get('accept-encoding'))
+    api_req._content_encoding = encoding
+    logger.info(f'发送具体任务，压缩方式: {encoding.value}')
+    data = await master.execute(api_req)
+
+    body = data._body
+    if body is None:
+        # 结果来自渲染结果缓存，在线程中压缩
+        body = await asyncio.to_thread(compress, (data.content or '').encode('utf-8'), encoding)
+
+    headers = {
+        'X-Msg': data.msg or '',
+        'X-Cookies': json.dumps(data.cookies or {}),
+        'Vary': 'Accept-Encoding',
+    }
+    if encoding != ContentEncoding.identity:
+        headers['Content-Encoding'] = encoding.value
+
+    logger.info('任务执行成功')
+
+    return StreamingResponse(iter_chunks(body), media_type='text/html; charset=utf-8', headers=headers)
+
+
+@app.post("/page_render")
+async def page_render(render_req: PageRenderRequestModel):
+    """
+    离线渲染 options.content 中的html，不请求网络，使用独立的子进程池
+    """
+    logger.info('发送离线渲染任务')
+    data = await render_master.execute(render_req)
 
     logger.info('任务执行成功')
 
     return data
+
+
+@app.post("/batch")
+async def batch(batch_req: BatchRequestModel, request: Request):
+    """
+    批量请求，按完成顺序以 ndjson 或 sse 流式返回每个请求的结果
+    """
+    if len(batch_req.items) > BATCH_MAX_ITEMS:
+        raise RequestException(f'单次最多 {BATCH_MAX_ITEMS} 个请求')
+    if 'text/event-stream' in request.headers.get('accept', ''):
+        batch_req.format = BatchFormat.sse
+
+    logger.info(f'发送批量任务，请求数: {len(batch_req.items)}')
+    media_type = 'text/event-stream' if batch_req.format == BatchFormat.sse else 'application/x-ndjson'
+
+    # 经过 nginx 时不缓冲，每个结果完成后立即返回
+    headers = {'X-Accel-Buffering': 'no'}
+    return StreamingResponse(stream_batch(batch_req, master.execute), media_type=media_type, headers=headers)
+
+
+@app.post("/jobs", status_code=202)
+async def submit_job(job_req: JobRequestModel) -> JobResponseModel:
+    """
+    提交异步任务，立即返回任务id
+    """
+    job = job_store.submit(job_req)
+    logger.info(f'提交异步任务: {job.id}')
+
+    return job
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str) -> JobResponseModel:
+    return job_store.get(job_id)
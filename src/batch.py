@@ -0,0 +1,105 @@
+# -*- coding:utf-8 -*-
+
+import time
+import asyncio
+
+from typing import AsyncIterator, Awaitable, Callable
+
+from fastapi import HTTPException
+from loguru import logger
+
+from utils import generation_sub_md5
+from models import APIRequestModel, APIResponseModel, BatchRequestModel, BatchItemResponseModel, BatchFormat
+from env import BATCH_CONCURRENCY, BATCH_MAX_CONCURRENCY
+
+
+async def run_batch(batch: BatchRequestModel,
+                    execute: Callable[[APIRequestModel], Awaitable[APIResponseModel]]
+                    ) -> AsyncIterator[BatchItemResponseModel]:
+    """
+    按限定的并发数执行批量请求，按完成顺序返回结果
+    每个请求的超时不超过批次剩余时间，批次超时后未完成的请求返回超时错误
+    """
+    deadline = time.time() + batch.timeout / 1000
+    concurrency = min(batch.concurrency or BATCH_CONCURRENCY, BATCH_MAX_CONCURRENCY)
+    semaphore = asyncio.Semaphore(concurrency)
+    results: asyncio.Queue = asyncio.Queue()
+
+    async def run_item(index: int, item: APIRequestModel):
+        async with semaphore:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise asyncio.TimeoutError()
+            if item.gotoOptions.timeout > remaining * 1000:
+                item = item.model_copy(deep=True)
+                item.gotoOptions.timeout = int(remaining * 1000)
+            return await execute(item)
+
+    def on_done(index: int, item: APIRequestModel, task: asyncio.Task):
+        if task.cancelled():
+            return
+
+        res = BatchItemResponseModel(index=index, url=str(item.url))
+        exc = task.exception()
+        if exc is None:
+            res.result = task.result()
+        elif isinstance(exc, asyncio.TimeoutError):
+            res.status_code, res.error = 504, '批次已超时'
+        elif isinstance(exc, HTTPException):
+            res.status_code, res.error = exc.status_code, str(exc.detail)
+        else:
+            logger.exception(exc)
+            res.status_code, res.error = 500, str(exc)
+        results.put_nowait(res)
+
+    # 相同指纹的请求相邻发送，便于调度到有相同预热context的子进程
+    order = sorted(range(len(batch.items)), key=lambda i: generation_sub_md5(batch.items[i]))
+    tasks = dict()
+    for index in order:
+        item = batch.items[index]
+        task = asyncio.create_task(run_item(index, item))
+        task.add_done_callback(lambda t, i=index, it=item: on_done(i, it, t))
+        tasks[index] = task
+
+    finished = set()
+    try:
+        while len(finished) < len(tasks):
+            remaining = deadline - time.time()
+            try:
+                res = await asyncio.wait_for(results.get(), max(remaining, 0))
+            except asyncio.TimeoutError:
+                break
+            finished.add(res.index)
+            yield res
+
+        while not results.empty():
+            res = results.get_nowait()
+            finished.add(res.index)
+            yield res
+
+        # 批次超时，取消未完成的请求
+        for index in order:
+            if index in finished:
+                continue
+            tasks[index].cancel()
+            yield BatchItemResponseModel(index=index, url=str(batch.items[index].url),
+                                         status_code=504, error='批次已超时')
+    finally:
+        # 客户端断开时取消剩余请求
+        for task in tasks.values():
+            task.cancel()
+
+
+async def stream_batch(batch: BatchRequestModel,
+                       execute: Callable[[APIRequestModel], Awaitable[APIResponseModel]]) -> AsyncIterator[str]:
+    """
+    ndjson 每行一个结果；sse 每个结果一个 data 事件，结束时发送 end 事件
+    """
+    async for res in run_batch(batch, execute):
+        if batch.format == BatchFormat.sse:
+            yield f'data: {res.model_dump_json()}\n\n'
+        else:
+            yield res.model_dump_json() + '\n'
+
+    if batch.format == BatchFormat.sse:
+        yield 'event: end\ndata: {}\n\n'
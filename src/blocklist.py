@@ -0,0 +1,113 @@
+# -*- coding:utf-8 -*-
+
+from pathlib import Path
+from typing import Set, Dict, List
+from urllib.parse import urlsplit
+
+from loguru import logger
+
+
+class DomainBlocklist:
+    """
+    广告、统计、追踪域名黑名单
+    域名保存在集合中，查询时依次检查主机名的各级后缀，命中任意一级即拦截
+    例如 a.b.example.com 依次检查 a.b.example.com、b.example.com、example.com、com
+
+    支持的文件格式（每行一条，# 开头为注释）：
+        example.com
+        0.0.0.0 example.com a.com    hosts 格式，可以有多个域名
+        ||example.com^               adblock 域名规则
+    """
+
+    def __init__(self, domains: Set[str] = None):
+        self.domains: Set[str] = domains or set()
+        # 按资源类型统计的平均响应大小，用于估算拦截节省的流量
+        self.size_total: Dict[str, int] = dict()
+        self.size_count: Dict[str, int] = dict()
+
+    def __len__(self):
+        return len(self.domains)
+
+    @staticmethod
+    def _normalize(host: str) -> str:
+        host = host.lower().lstrip('.').rstrip('.')
+        if any(c in host for c in '/*^$|:') or '.' not in host:
+            return ''
+        # IP 地址（hosts 格式的地址列）和本机地址不拦截
+        if host in ('localhost', 'localhost.localdomain') or host.replace('.', '').isdigit():
+            return ''
+        return host
+
+    @classmethod
+    def parse_line(cls, line: str) -> List[str]:
+        line = line.strip()
+        if not line or line.startswith(('#', '!', '[')):
+            return []
+
+        if line.startswith('||'):
+            line = line[2:]
+            # 带路径、通配符或其他选项的规则不是单纯的域名规则，忽略
+            if line.endswith('^'):
+                line = line[:-1]
+            elif '^$' in line:
+                return []
+            hosts = [line]
+        else:
+            parts = line.split('#', 1)[0].split()
+            # hosts 格式，地址之后的每一列都是域名
+            hosts = parts[1:] if len(parts) > 1 else parts
+
+        domains = [cls._normalize(host) for host in hosts]
+        return [domain for domain in domains if domain]
+
+    @classmethod
+    def load(cls, path: str) -> 'DomainBlocklist':
+        """
+        从本地文件加载，文件不存在时返回空名单
+        """
+        if not path:
+            return cls()
+
+        file = Path(path)
+        if not file.is_file():
+            logger.warning(f'blocklist file not find: {path}')
+            return cls()
+
+        domains = set()
+        with file.open(encoding='utf-8', errors='ignore') as f:
+            for line in f:
+                domains.update(cls.parse_line(line))
+
+        logger.info(f'load blocklist {path}, domains: {len(domains)}')
+
+        return cls(domains)
+
+    def is_blocked_host(self, host: str) -> bool:
+        if not host or not self.domains:
+            return False
+
+        host = host.lower()
+        while True:
+            if host in self.domains:
+                return True
+            _, dot, host = host.partition('.')
+            if not dot:
+                return False
+
+    def is_blocked(self, url: str) -> bool:
+        try:
+            host = urlsplit(url).hostname
+        except ValueError:
+            return False
+
+        return self.is_blocked_host(host)
+
+    def record_size(self, resource_type: str, size: int):
+        self.size_total[resource_type] = self.size_total.get(resource_type, 0) + size
+        self.size_count[resource_type] = self.size_count.get(resource_type, 0) + 1
+
+    def estimate_size(self, resource_type: str) -> int:
+        count = self.size_count.get(resource_type)
+        if not count:
+            return 0
+        return self.size_total[resource_type] // count
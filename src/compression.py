@@ -0,0 +1,80 @@
+# -*- coding:utf-8 -*-
+
+import gzip
+
+from typing import Iterator
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from models import ContentEncoding
+from env import COMPRESS_LEVEL, RAW_CHUNK_KB
+
+
+def available_encodings():
+    """
+    服务端支持的压缩方式，按优先级排列；brotli、zstandard 未安装时不支持对应的压缩方式
+    """
+    encodings = []
+    if zstandard is not None:
+        encodings.append(ContentEncoding.zstd)
+    if brotli is not None:
+        encodings.append(ContentEncoding.br)
+    encodings.append(ContentEncoding.gzip)
+    return encodings
+
+
+def negotiate_encoding(accept_encoding: str) -> ContentEncoding:
+    """
+    根据 Accept-Encoding 选择压缩方式：客户端 q 值高的优先，相同时按服务端优先级；都不接受时不压缩
+    """
+    accepted = dict()
+    for item in (accept_encoding or '').split(','):
+        name, _, params = item.strip().partition(';')
+        name = name.strip().lower()
+        if not name:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[name] = q
+
+    candidates = []
+    for priority, encoding in enumerate(available_encodings()):
+        q = accepted.get(encoding.value, accepted.get('*', 0.0))
+        if q > 0:
+            candidates.append((-q, priority, encoding))
+
+    if not candidates:
+        return ContentEncoding.identity
+    return min(candidates)[2]
+
+
+def compress(data: bytes, encoding: ContentEncoding, level=COMPRESS_LEVEL) -> bytes:
+    """
+    level 为 1~9，brotli 映射到 0~11，zstd 直接使用
+    """
+    if encoding == ContentEncoding.gzip:
+        return gzip.compress(data, compresslevel=level)
+    if encoding == ContentEncoding.br:
+        return brotli.compress(data, quality=min(round(level * 11 / 9), 11))
+    if encoding == ContentEncoding.zstd:
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    return data
+
+
+def iter_chunks(body: bytes, chunk_size=RAW_CHUNK_KB * 1024) -> Iterator[bytes]:
+    view = memoryview(body)
+    for start in range(0, len(view), chunk_size):
+        yield bytes(view[start:start + chunk_size])
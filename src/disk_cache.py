@@ -0,0 +1,119 @@
+# -*- coding:utf-8 -*-
+
+import os
+import json
+import time
+import sqlite3
+import threading
+
+from pathlib import Path
+from typing import Optional, Tuple
+
+from loguru import logger
+
+
+class DiskLRU:
+    """
+    基于sqlite索引的磁盘LRU缓存，可被同一台机器的多个进程共享，进程重启后仍然保留
+    内容保存在 directory/data 下的文件中，索引记录大小、过期时间以及最近访问时间
+    超过 max_bytes 时按最近访问时间淘汰
+    """
+
+    def __init__(self, directory: str, max_bytes: int, name: str = 'cache'):
+        self.directory = Path(directory)
+        self.data_dir = self.directory / 'data'
+        self.data_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+        self.conn = sqlite3.connect(str(self.directory / f'{name}.sqlite'),
+                                    timeout=10, check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS entries (
+            key TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            meta TEXT NOT NULL,
+            expires REAL NOT NULL,
+            accessed REAL NOT NULL
+        )''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)')
+
+    def _path(self, key: str) -> Path:
+        return self.data_dir / key[:2] / key
+
+    def get(self, key: str) -> Optional[Tuple[dict, bytes, float]]:
+        """
+        返回 (meta, body, expires)，不存在时返回None。过期的内容同样返回，由调用方决定是否重新验证
+        """
+        with self.lock:
+            row = self.conn.execute('SELECT meta, expires FROM entries WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+
+            try:
+                body = self._path(key).read_bytes()
+            except OSError:
+                self.conn.execute('DELETE FROM entries WHERE key = ?', (key,))
+                return None
+
+            self.conn.execute('UPDATE entries SET accessed = ? WHERE key = ?', (time.time(), key))
+
+        return json.loads(row[0]), body, row[1]
+
+    def set(self, key: str, meta: dict, body: bytes, expires: float):
+        if len(body) > self.max_bytes:
+            return
+
+        path = self._path(key)
+        path.parent.mkdir(exist_ok=True)
+        # 先写临时文件再替换，其他进程不会读到写了一半的内容
+        tmp_path = path.with_name(f'{key}.{os.getpid()}.{threading.get_ident()}.tmp')
+        tmp_path.write_bytes(body)
+        os.replace(tmp_path, path)
+
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO entries (key, size, meta, expires, accessed) VALUES (?, ?, ?, ?, ?)',
+                (key, len(body), json.dumps(meta), expires, time.time())
+            )
+            self._evict()
+
+    def update(self, key: str, meta: dict, expires: float):
+        """
+        内容不变，只更新meta以及过期时间（例如重新验证后）
+        """
+        with self.lock:
+            self.conn.execute('UPDATE entries SET meta = ?, expires = ?, accessed = ? WHERE key = ?',
+                              (json.dumps(meta), expires, time.time(), key))
+
+    def delete(self, key: str):
+        with self.lock:
+            self.conn.execute('DELETE FROM entries WHERE key = ?', (key,))
+        self._path(key).unlink(missing_ok=True)
+
+    def total_size(self) -> int:
+        with self.lock:
+            return self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+
+    def _evict(self):
+        total = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        rows = self.conn.execute('SELECT key, size FROM entries ORDER BY accessed').fetchall()
+        evicted = []
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            evicted.append(key)
+            total -= size
+
+        self.conn.executemany('DELETE FROM entries WHERE key = ?', [(key,) for key in evicted])
+        for key in evicted:
+            self._path(key).unlink(missing_ok=True)
+        logger.info(f'disk cache evict {len(evicted)} entries, size: {total}')
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -20,9 +20,76 @@ MAX_TASK_NUMBER = get_env('MAX_TASK_NUMBER', 1, arg_formatter=int)
 PORT = get_env('PORT', 8000, arg_formatter=int)
 MAX_TASK_LIVE_TIME = get_env('MAX_TASK_LIVE_TIME', 60 * 60, arg_formatter=int)
 MAX_TASK_IDLE_TIME = get_env('MAX_TASK_IDLE_TIME', 60 * 20, arg_formatter=int)
+# 单个子进程最多执行的任务数，超过后回收重建。0 表示不限制
+MAX_TASK_REQUESTS = get_env('MAX_TASK_REQUESTS', 500, arg_formatter=int)
+# 单个子进程（一个浏览器）同时执行的任务数，每个任务使用独立的context；默认1，大于1时开启
+MAX_WORKER_PAGES = get_env('MAX_WORKER_PAGES', 1, arg_formatter=int)
+# 保持的最少空闲子进程数，不超过 MAX_TASK_NUMBER
+MIN_IDLE_WORKERS = get_env('MIN_IDLE_WORKERS', 1, arg_formatter=int)
+# 子进程池扩缩容：最少子进程数、预留系数、缩容延迟（秒）
+MIN_TASK_NUMBER = get_env('MIN_TASK_NUMBER', 1, arg_formatter=int)
+SCALE_HEADROOM = get_env('SCALE_HEADROOM', 1.2, arg_formatter=float)
+SCALE_DOWN_DELAY = get_env('SCALE_DOWN_DELAY', 60, arg_formatter=int)
+# 单个子进程预估内存（MB）、容器内存使用上限比例、每个CPU核运行的子进程数，用于限制扩容
+WORKER_MEMORY_MB = get_env('WORKER_MEMORY_MB', 300, arg_formatter=int)
+MEMORY_LIMIT_RATIO = get_env('MEMORY_LIMIT_RATIO', 0.85, arg_formatter=float)
+WORKERS_PER_CPU = get_env('WORKERS_PER_CPU', 5, arg_formatter=float)
+# 子进程资源监控：采样间隔（秒）、进程树内存上限（MB）、CPU上限（百分比，0表示不限制）
+# 超过上限的子进程执行完剩余任务后回收；容器内存使用超过 ADMISSION_MEMORY_RATIO 时暂停分配新任务
+MONITOR_INTERVAL = get_env('MONITOR_INTERVAL', 5, arg_formatter=int)
+WORKER_MAX_RSS_MB = get_env('WORKER_MAX_RSS_MB', 1024, arg_formatter=int)
+WORKER_MAX_CPU_PERCENT = get_env('WORKER_MAX_CPU_PERCENT', 0, arg_formatter=float)
+ADMISSION_MEMORY_RATIO = get_env('ADMISSION_MEMORY_RATIO', 0.9, arg_formatter=float)
+# 启动时并行预热 MIN_IDLE_WORKERS 个子进程，子进程预先创建好浏览器、默认上下文及伪造脚本
+PREWARM = get_env('PREWARM', 'true', arg_formatter=lambda v: str(v).lower() == 'true')
+# 每个子进程最多保留的预热context数，每个 (user_agent, 代理) 组合一个，调度时优先分配给有相同预热context的子进程
+MAX_SPARE_CONTEXTS = get_env('MAX_SPARE_CONTEXTS', 2, arg_formatter=int)
+# 代理转发方式：bridge（子进程内的asyncio转发）, gost（主进程管理的gost转发）
+PROXY_BACKEND = get_env('PROXY_BACKEND', 'bridge')
+# 代理转发空闲关闭时间（秒）、gost启动等待端口可用的超时时间（秒）
+FORWARDER_IDLE_TIME = get_env('FORWARDER_IDLE_TIME', 300, arg_formatter=int)
+FORWARDER_START_TIMEOUT = get_env('FORWARDER_START_TIMEOUT', 5, arg_formatter=float)
+# bridge 每个上游代理预先建立并完成认证的连接数，以及连接在池中的最长保留时间（秒）
+PROXY_BRIDGE_POOL_SIZE = get_env('PROXY_BRIDGE_POOL_SIZE', 2, arg_formatter=int)
+PROXY_BRIDGE_POOL_IDLE = get_env('PROXY_BRIDGE_POOL_IDLE', 10, arg_formatter=float)
+# 广告、追踪域名黑名单文件（hosts 或 adblock 域名规则），为空时不启用
+BLOCKLIST_PATH = get_env('BLOCKLIST_PATH', '')
+# 静态子资源（js、css、字体、图片）共享磁盘缓存目录，为空时不启用；缓存总大小以及单个资源上限（MB）
+RESOURCE_CACHE_DIR = get_env('RESOURCE_CACHE_DIR', '')
+RESOURCE_CACHE_MAX_MB = get_env('RESOURCE_CACHE_MAX_MB', 1024, arg_formatter=int)
+RESOURCE_CACHE_MAX_ITEM_MB = get_env('RESOURCE_CACHE_MAX_ITEM_MB', 5, arg_formatter=int)
+# 渲染结果缓存：有效期（秒，0表示不启用）、内存上限（MB）、磁盘缓存目录（为空时只使用内存）以及磁盘上限（MB）
+RESULT_CACHE_TTL = get_env('RESULT_CACHE_TTL', 0, arg_formatter=int)
+RESULT_CACHE_MEMORY_MB = get_env('RESULT_CACHE_MEMORY_MB', 256, arg_formatter=int)
+RESULT_CACHE_DIR = get_env('RESULT_CACHE_DIR', '')
+RESULT_CACHE_DISK_MB = get_env('RESULT_CACHE_DISK_MB', 1024, arg_formatter=int)
+# 批量接口：单次最多请求数、默认以及最大并发数
+BATCH_MAX_ITEMS = get_env('BATCH_MAX_ITEMS', 1000, arg_formatter=int)
+BATCH_CONCURRENCY = get_env('BATCH_CONCURRENCY', 8, arg_formatter=int)
+BATCH_MAX_CONCURRENCY = get_env('BATCH_MAX_CONCURRENCY', 64, arg_formatter=int)
+# 异步任务：最多保留的任务数、完成后保留时间（秒）、同时执行的任务数、回调超时（秒）以及重试次数
+JOB_MAX_ITEMS = get_env('JOB_MAX_ITEMS', 10000, arg_formatter=int)
+JOB_TTL = get_env('JOB_TTL', 600, arg_formatter=int)
+JOB_CONCURRENCY = get_env('JOB_CONCURRENCY', 16, arg_formatter=int)
+JOB_CALLBACK_TIMEOUT = get_env('JOB_CALLBACK_TIMEOUT', 10, arg_formatter=float)
+JOB_CALLBACK_RETRIES = get_env('JOB_CALLBACK_RETRIES', 3, arg_formatter=int)
+# /page_render 离线渲染子进程池：最多子进程数（默认0，与抓取共用子进程池）、最少子进程数、最少空闲子进程数以及单个子进程同时执行的任务数
+RENDER_MAX_TASK_NUMBER = get_env('RENDER_MAX_TASK_NUMBER', 0, arg_formatter=int)
+RENDER_MIN_TASK_NUMBER = get_env('RENDER_MIN_TASK_NUMBER', 1, arg_formatter=int)
+RENDER_MIN_IDLE_WORKERS = get_env('RENDER_MIN_IDLE_WORKERS', 1, arg_formatter=int)
+RENDER_MAX_WORKER_PAGES = get_env('RENDER_MAX_WORKER_PAGES', 4, arg_formatter=int)
+# /get_content_raw 的压缩等级（1~9）以及分块返回的大小（KB）
+COMPRESS_LEVEL = get_env('COMPRESS_LEVEL', 6, arg_formatter=int)
+RAW_CHUNK_KB = get_env('RAW_CHUNK_KB', 64, arg_formatter=int)
+# 浏览器伪造方式：default（pjstealth 全部伪造 + 自定义伪造）、minimal（只使用自定义伪造）、off
+STEALTH_PROFILE = get_env('STEALTH_PROFILE', 'default')
+# 页面内容超过该大小（KB）时子进程通过共享内存传给主进程，0表示不启用
+SHM_TRANSFER_MIN_KB = get_env('SHM_TRANSFER_MIN_KB', 256, arg_formatter=int)
 
 OPEN_SENTRY = get_env("OPEN_SENTRY", "false")
 SENTRY_NSD = get_env("SENTRY_NSD", "")
+# sentry 性能追踪采样率，请求耗时已通过 /metrics 统计，无需全量追踪
+SENTRY_TRACES_SAMPLE_RATE = get_env("SENTRY_TRACES_SAMPLE_RATE", 0.05, arg_formatter=float)
 if OPEN_SENTRY.lower() == 'true':
     OPEN_SENTRY = True
 else:
@@ -38,3 +38,25 @@ class TimeoutException(HTTPException):
         status_code = status.HTTP_408_REQUEST_TIMEOUT
         detail = detail or '请求超时！'
         super().__init__(status_code=status_code, detail=detail, headers=headers)
+
+
+class NotFoundException(HTTPException):
+    def __init__(
+            self,
+            detail: Any = None,
+            headers: Optional[Dict[str, str]] = None,
+    ):
+        status_code = status.HTTP_404_NOT_FOUND
+        detail = detail or '资源不存在！'
+        super().__init__(status_code=status_code, detail=detail, headers=headers)
+
+
+class TooManyRequestsException(HTTPException):
+    def __init__(
+            self,
+            detail: Any = None,
+            headers: Optional[Dict[str, str]] = None,
+    ):
+        status_code = status.HTTP_429_TOO_MANY_REQUESTS
+        detail = detail or '请求过多！'
+        super().__init__(status_code=status_code, detail=detail, headers=headers)
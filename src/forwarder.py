@@ -0,0 +1,138 @@
+# -*- coding:utf-8 -*-
+
+import time
+import asyncio
+
+from dataclasses import dataclass
+from typing import Dict
+
+from loguru import logger
+
+from utils import get_unused_port
+from exception import InternalException
+from env import FORWARDER_IDLE_TIME, FORWARDER_START_TIMEOUT
+
+
+def normalize_proxy_url(proxy: str, proxy_type: str = 'http') -> str:
+    """
+    request_proxy 允许不带协议，例如 '115.216.42.180:31081'，此时使用 request_proxy_type
+    """
+    if '://' not in proxy:
+        proxy = f'{proxy_type}://{proxy}'
+    return proxy
+
+
+@dataclass
+class Forwarder:
+    upstream: str
+    port: int
+    process: asyncio.subprocess.Process
+    users: int = 0
+    last_used: float = 0
+
+    @property
+    def local_url(self) -> str:
+        return f'http://127.0.0.1:{self.port}'
+
+    @property
+    def alive(self) -> bool:
+        return self.process.returncode is None
+
+
+class ForwarderManager:
+    """
+    常驻的gost转发管理，运行在主进程的事件循环中
+    每个上游代理只启动一个本地监听，所有子进程共用；按使用者计数，空闲超过 idle_time 后关闭
+    """
+
+    def __init__(self, idle_time=FORWARDER_IDLE_TIME, start_timeout=FORWARDER_START_TIMEOUT):
+        self.idle_time = idle_time
+        self.start_timeout = start_timeout
+        self.forwarders: Dict[str, Forwarder] = dict()
+        self.locks: Dict[str, asyncio.Lock] = dict()
+
+    @staticmethod
+    async def _probe_port(port) -> bool:
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+        except OSError:
+            return False
+        writer.close()
+        return True
+
+    async def _start(self, upstream: str) -> Forwarder:
+        # 随机端口可能被占用，gost绑定失败会直接退出，换端口重试
+        for _ in range(3):
+            port = get_unused_port()
+            cmd = ['gost', '-L', f'127.0.0.1:{port}', '-F', upstream]
+            process = await asyncio.create_subprocess_exec(*cmd)
+            logger.info(f'gost 转发启动。pid: {process.pid}, port: {port}')
+
+            deadline = time.time() + self.start_timeout
+            while time.time() < deadline and process.returncode is None:
+                if await self._probe_port(port):
+                    return Forwarder(upstream=upstream, port=port, process=process)
+                await asyncio.sleep(0.05)
+
+            await self._stop(Forwarder(upstream=upstream, port=port, process=process))
+
+        raise InternalException('代理转发启动失败')
+
+    @staticmethod
+    async def _stop(forwarder: Forwarder):
+        if forwarder.alive:
+            forwarder.process.kill()
+        try:
+            await asyncio.wait_for(forwarder.process.wait(), 1)
+        except asyncio.TimeoutError:
+            logger.error(f'gost 转发关闭失败。pid: {forwarder.process.pid}')
+            return
+        logger.info(f'gost 转发关闭。pid: {forwarder.process.pid}, port: {forwarder.port}')
+
+    async def acquire(self, upstream: str) -> str:
+        """
+        获取上游代理对应的本地http代理地址，使用结束后需要调用 release
+        """
+        lock = self.locks.setdefault(upstream, asyncio.Lock())
+        async with lock:
+            forwarder = self.forwarders.get(upstream)
+            if forwarder and not forwarder.alive:
+                logger.warning(f'gost 转发已退出，重新启动。port: {forwarder.port}')
+                self.forwarders.pop(upstream, None)
+                forwarder = None
+
+            if forwarder is None:
+                forwarder = await self._start(upstream)
+                self.forwarders[upstream] = forwarder
+
+            forwarder.users += 1
+            forwarder.last_used = time.time()
+
+        return forwarder.local_url
+
+    def release(self, upstream: str):
+        forwarder = self.forwarders.get(upstream)
+        if forwarder:
+            forwarder.users = max(forwarder.users - 1, 0)
+            forwarder.last_used = time.time()
+
+    async def evict_idle(self):
+        """
+        关闭空闲超时以及已退出的转发
+        """
+        now = time.time()
+        for upstream, forwarder in list(self.forwarders.items()):
+            if forwarder.alive and (forwarder.users > 0 or now - forwarder.last_used < self.idle_time):
+                continue
+
+            lock = self.locks.get(upstream)
+            if lock and lock.locked():
+                continue
+            self.forwarders.pop(upstream, None)
+            self.locks.pop(upstream, None)
+            await self._stop(forwarder)
+
+    async def close(self):
+        for forwarder in list(self.forwarders.values()):
+            await self._stop(forwarder)
+        self.forwarders.clear()
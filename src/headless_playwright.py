@@ -1,13 +1,21 @@
 
+import re
 import time
-import subprocess
+import asyncio
 from pathlib import Path
+from urllib.parse import urlsplit
+from collections import defaultdict
 from loguru import logger
-from typing import List, Union, Optional, Dict
+from typing import List, Union, Optional, Dict, Tuple
 
-from playwright.sync_api import sync_playwright, Page, Route, ProxySettings
-from playwright_stealth import stealth_sync
-from pjstealth import stealth_sync
+from playwright.async_api import async_playwright, Page, Frame, Route, ProxySettings, BrowserContext, Response, \
+    TimeoutError as PlaywrightTimeoutError
+
+from utils import StageTimer
+from blocklist import DomainBlocklist
+from resource_cache import ResourceCache
+from stealth import StealthProfile, build_stealth_script
+from page_wait import wait_for_content, wait_for_settle, NetworkTracker
 
 
 class BrowserType:
@@ -23,6 +31,7 @@ class Partial:
     def __call__(self, *args):
         return self.func(*args, **self.kwargs)
 
+
 class PlaywrightHandler:
     def __init__(self,
                 executable_path: Union[str, Path] = None,
@@ -31,11 +40,15 @@ class PlaywrightHandler:
                 ignore_default_args: Union[bool, List[str]]=None,
                 proxy: ProxySettings=None,
                 browser_type: str=BrowserType.firefox, 
+                blocklist: DomainBlocklist=None,
+                resource_cache: ResourceCache=None,
+                max_spare_pages: int=2,
+                spare_proxy: bool=True,
+                stealth_profile: str=StealthProfile.default,
                 **kwargs):
         """
-        初始化浏览器
-        1. 创建pw实例
-        2. 创建browser对象
+        初始化浏览器参数，调用 start 后创建pw实例以及browser对象
+        一个browser可以同时服务多个任务，每个任务使用独立的context
 
         Parameters
         ----------
@@ -58,13 +71,20 @@ class PlaywrightHandler:
             Network proxy settings.
         browser_type : str
             可选： 'chromium', 'firefox', 'webkit'
+        blocklist : DomainBlocklist
+            广告、追踪域名黑名单，命中的请求在浏览器发出前拒绝
+        resource_cache : ResourceCache
+            静态子资源的共享磁盘缓存，多个子进程共用
+        max_spare_pages : int
+            最多保留的预热页面数，每个 (user_agent, proxy) 组合一个
+        spare_proxy : bool
+            是否为带代理的context预热页面，代理地址可能失效时设置为False
+        stealth_profile : str
+            浏览器伪造方式，可选： 'default', 'minimal', 'off'
         kwargs
             其他实例化参数
         """
-        logger.info('start init playwright.')
-        self.pw = sync_playwright().start()
-        self.browser_type = self._get_browser_type(browser_type=browser_type)
-        self.browser = self.browser_type.launch(
+        self.launch_kwargs = dict(
             executable_path=executable_path,
             headless=headless,
             args=args,
@@ -72,12 +92,38 @@ class PlaywrightHandler:
             proxy=proxy,
             **kwargs
         )
-        self.context = None
-        self.page = None
-        self.save_stack = None
+        self.browser_type_name = browser_type
+        self.blocklist = blocklist if blocklist else None
+        self.resource_cache = resource_cache
+        self.pw = None
+        self.browser_type = None
+        self.browser = None
+        self.prewarm_enabled = False
+        self.max_spare_pages = max_spare_pages
+        self.spare_proxy = spare_proxy
+        self.stealth_profile = stealth_profile
+        # 预热页面 (user_agent, proxy) -> page，以及各组合的使用热度，淘汰时优先淘汰热度最低的
+        self.spare_pages: Dict[Tuple[str, str], Page] = dict()
+        self.spare_hits: Dict[Tuple[str, str], float] = dict()
+        self._prewarm_tasks: Dict[Tuple[str, str], asyncio.Task] = dict()
         self.user_agent = 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/119.0.0.0 Safari/537.36'
+
+    async def start(self, prewarm: bool=False):
+        """
+        1. 创建pw实例
+        2. 创建browser对象
+        3. 预热默认页面（可选）
+        """
+        logger.info('start init playwright.')
+        self.pw = await async_playwright().start()
+        self.browser_type = self._get_browser_type(browser_type=self.browser_type_name)
+        self.browser = await self.browser_type.launch(**self.launch_kwargs)
         logger.info('start init playwright browser finish.')
 
+        self.prewarm_enabled = prewarm
+        if prewarm:
+            await self.prewarm()
+
     def _get_browser_type(self, browser_type: str=BrowserType.firefox):
         """
         获取browser类型
@@ -93,47 +139,24 @@ class PlaywrightHandler:
             logger.warning('browser_type not find. use firefox')
             return self.pw.firefox
 
-    def _on_context_page(self, page: Page):
-        """
-        context 拦截器 在创建page对象后执行
-        """
-        stealth_sync(page)  # 浏览器伪造
-        page.evaluate('''() =>{
-                       Object.defineProperties(navigator,{
-                         webdriver:{
-                           get: () => false
-                         }
-                       })
-                    }''')
-        page.evaluate('''() => {
-                      const originalQuery = window.navigator.permissions.query;
-                      return window.navigator.permissions.query = (parameters) => (
-                        parameters.name === 'notifications' ?
-                          Promise.resolve({ state: Notification.permission }) :
-                          originalQuery(parameters)
-                      );
-                    }
-                    ''')
-        page.evaluate('''() =>{
-                Object.defineProperty(navigator, 'plugins', {
-                get: () => [1, 2, 3, 4, 5],
-                    });
-                }''')
-        
-        self.on_page(page)
+    async def _on_context_page(self, page: Page):
+        """
+        在创建page对象后执行
+        """
+        await self.on_page(page)
 
-    def on_page(self, page: Page):
+    async def on_page(self, page: Page):
         """
         子类可以继承此方法，方便自定义创建page的动作
         """
         pass
     
-    def _get_context(self,
+    async def _get_context(self,
                     user_agent: str = None,
                     extra_http_headers: Optional[Dict[str, str]] = None,
                     proxy: ProxySettings = None,
                     **kwargs
-                    ):
+                    ) -> BrowserContext:
         """
         获取上下文对象
         类似打开一个无痕浏览器
@@ -155,7 +178,7 @@ class PlaywrightHandler:
         if user_agent is None:
             user_agent = self.user_agent
 
-        self.context = self.browser.new_context(
+        context = await self.browser.new_context(
             user_agent=user_agent,
             extra_http_headers=extra_http_headers,
             proxy=proxy,
@@ -163,32 +186,167 @@ class PlaywrightHandler:
             **kwargs
         )
 
-        self.context.on('page', self._on_context_page)
         logger.info('create context finish.')
 
-    def _clean_save_stack(self):
-        self.save_stack = []
-        logger.info('init save_stack.')
+        return context
 
-    def handle_route(self, route: Route, ignore_resource=None, save_stack=False):
+    async def handle_route(self, route: Route, ignore_resource=None, save_stack: list = None,
+                           offline_mode: bool = False, reject_patterns: List[re.Pattern] = None,
+                           block_stats: dict = None, cache_stats: dict = None):
         """
         ignore_resource  忽略资源的列表  ("image", "stylesheet", "media", "eventsource", "websocket")
-        save_stack 是否保存堆栈
+        save_stack 保存堆栈的列表，为None时不保存
+        offline_mode 离线模式，只请求主文档，其他请求全部拒绝
+        reject_patterns 拒绝url匹配的请求
+        block_stats 黑名单拦截统计，为None时不检查黑名单
+        cache_stats 子资源缓存统计，为None时不使用缓存
         """
 
         request = route.request
-        if save_stack:
-            self.save_stack.append(request)
+        if save_stack is not None:
+            save_stack.append(request)
+
+        if (block_stats is not None and self.blocklist.is_blocked(request.url)
+                and not self._is_main_document(request)):
+            block_stats['count'] += 1
+            block_stats['bytes_saved'] += self.blocklist.estimate_size(request.resource_type)
+            await route.abort('blockedbyclient')
+            return
+
+        if offline_mode and not self._is_main_document(request):
+            await route.abort()
+            return
+
+        if reject_patterns and any(p.search(request.url) for p in reject_patterns):
+            await route.abort()
+            return
 
         # 动态设置忽略的资源
         if ignore_resource is None:
             ignore_resource = []
         if request.resource_type in ignore_resource:
-            route.abort()
+            await route.abort()
+        elif cache_stats is not None and self.resource_cache.is_cacheable_request(request):
+            await self._handle_cached_route(route, cache_stats)
         else:
-            route.continue_()
-    
-    def get_new_page(self, 
+            await route.continue_()
+
+    async def _handle_cached_route(self, route: Route, cache_stats: dict):
+        try:
+            await self.resource_cache.handle(route, cache_stats)
+        except Exception as e:
+            logger.warning(f'resource cache fail: {route.request.url}, {e}')
+            try:
+                await route.continue_()
+            except Exception:
+                pass
+
+    def _on_response(self, response: Response):
+        """
+        记录各类型资源的响应大小，用于估算黑名单拦截节省的流量
+        """
+        size = response.headers.get('content-length')
+        if size and size.isdigit():
+            self.blocklist.record_size(response.request.resource_type, int(size))
+
+    @staticmethod
+    def _is_main_document(request) -> bool:
+        try:
+            return request.is_navigation_request() and request.frame.parent_frame is None
+        except Exception:
+            return False
+
+    async def _create_page(self,
+                    user_agent: str = None,
+                    extra_http_headers: Optional[Dict[str, str]] = None,
+                    proxy: ProxySettings = None,
+                    **kwargs) -> Page:
+        """
+        创建独立的context以及page，并执行浏览器伪造
+        """
+        context = await self._get_context(
+            user_agent=user_agent,
+            extra_http_headers=extra_http_headers,
+            proxy=proxy,
+            **kwargs
+        )
+        
+        if not context:
+            raise Exception("实例化context失败")
+
+        try:
+            # 浏览器伪造合并为一个脚本，在context中注册一次，页面自身脚本执行前生效
+            stealth_script = build_stealth_script(self.stealth_profile, user_agent or self.user_agent)
+            if stealth_script:
+                await context.add_init_script(script=stealth_script)
+            page = await context.new_page()
+            await self._on_context_page(page)
+        except Exception:
+            await self.close_context(context)
+            raise
+
+        return page
+
+    @staticmethod
+    def spare_key(user_agent: str = None, proxy: ProxySettings = None) -> Tuple[str, str]:
+        return user_agent or '', (proxy or {}).get('server') or ''
+
+    async def prewarm(self, user_agent: str = None, proxy: ProxySettings = None):
+        """
+        预先创建一个指定 user_agent、代理的页面，下一个相同参数的任务可直接使用
+        页面数超过上限时淘汰使用热度最低的预热页面
+        """
+        if self.max_spare_pages <= 0:
+            return
+
+        key = self.spare_key(user_agent, proxy)
+        if key in self.spare_pages:
+            return
+
+        try:
+            page = await self._create_page(user_agent=user_agent, proxy=proxy)
+        except Exception as e:
+            logger.exception(e)
+            return
+
+        self.spare_pages[key] = page
+        while len(self.spare_pages) > self.max_spare_pages:
+            candidates = [k for k in self.spare_pages if k != key]
+            if not candidates:
+                break
+            evict_key = min(candidates, key=lambda k: self.spare_hits.get(k, 0))
+            await self.close_context(self.spare_pages.pop(evict_key).context)
+            logger.info(f'evict prewarmed page. user_agent: {evict_key[0]}, proxy: {evict_key[1]}')
+        logger.info('prewarm page finish.')
+
+    def _record_spare_hit(self, key: Tuple[str, str]):
+        # 热度按次数衰减，最近常用的组合热度更高
+        for k in list(self.spare_hits):
+            self.spare_hits[k] *= 0.9
+            if self.spare_hits[k] < 0.01:
+                self.spare_hits.pop(k)
+        self.spare_hits[key] = self.spare_hits.get(key, 0) + 1
+
+    def _schedule_prewarm(self, user_agent: str = None, proxy: ProxySettings = None):
+        if not self.prewarm_enabled or self.max_spare_pages <= 0:
+            return
+        if proxy and not self.spare_proxy:
+            return
+        key = self.spare_key(user_agent, proxy)
+        task = self._prewarm_tasks.get(key)
+        if task and not task.done():
+            return
+        self._prewarm_tasks[key] = asyncio.create_task(self.prewarm(user_agent=user_agent, proxy=proxy))
+        self._prewarm_tasks[key].add_done_callback(lambda t: self._prewarm_tasks.pop(key, None))
+
+    async def discard_spare_pages(self, proxy_server: str):
+        """
+        代理转发关闭后，使用该代理的预热页面已不可用
+        """
+        for key in [k for k in self.spare_pages if k[1] == proxy_server]:
+            await self.close_context(self.spare_pages.pop(key).context)
+
+    async def get_new_page(self, 
                     user_agent: str = None,
                     extra_http_headers: Optional[Dict[str, str]] = None,
                     proxy: ProxySettings = None,
@@ -196,75 +354,165 @@ class PlaywrightHandler:
                     cookies: List[Dict[str, str]] = None,
                     headers: Dict[str, str] = None,
                     use_cache: bool=True,
-                    save_stack: bool=False,
+                    save_stack: list=None,
                     ignore_resource: List[str]=None,
+                    offline_mode: bool=False,
+                    reject_patterns: List[re.Pattern]=None,
+                    block_stats: dict=None,
+                    cache_stats: dict=None,
 
-                    **kwargs):
+                    **kwargs) -> Page:
         """
         创建一个新的页面
-        1. 根据参数以及self.context判断是否创建context对象。
+        1. 每个页面使用独立的context对象，多个任务并发时互不影响。优先使用 user_agent、代理相同的预热页面。
         2. 设置request和response hook
         """
-        if not self.context:
-            self._get_context(
+        key = self.spare_key(user_agent, proxy)
+        prewarmable = extra_http_headers is None and not kwargs
+        if prewarmable:
+            self._record_spare_hit(key)
+
+        if prewarmable and key in self.spare_pages:
+            page = self.spare_pages.pop(key)
+            logger.info('use prewarmed page.')
+        else:
+            page = await self._create_page(
                 user_agent=user_agent,
                 extra_http_headers=extra_http_headers,
                 proxy=proxy,
                 **kwargs
             )
-        
-        if not self.context:
-            raise Exception("实例化context失败")
-        
-        # todo 若多个页面，会影响到其他页面。
-        if cookies:
-            self.context.clear_cookies()
-            self.context.add_cookies(cookies=cookies)
-            logger.info('add cookies success.')
+        if prewarmable:
+            # 只替换context，不重启浏览器，为下一个相同参数的任务预热
+            self._schedule_prewarm(user_agent=user_agent, proxy=proxy)
+        context = page.context
 
-        page = self.context.new_page()
+        try:
+            if cookies:
+                await context.add_cookies(cookies=cookies)
+                logger.info('add cookies success.')
 
-        if headers:
-            page.set_extra_http_headers(headers=headers)
-            logger.info('add headers success.')
+            if headers:
+                await page.set_extra_http_headers(headers=headers)
+                logger.info('add headers success.')
 
-        if not use_cache:
-            page.set_extra_http_headers({"Cache-Control": "no-cache"})
-            logger.info('set Cache-Control use no-cache.')
-        
-        if ignore_resource and save_stack:
-            self._clean_save_stack()
-            page_global_hook = Partial(self.handle_route,
-                                        ignore_resource=ignore_resource, 
-                                        save_stack=save_stack)
-
-            page.route("**/*", page_global_hook)
-            logger.info('hook all request.')
+            if not use_cache:
+                await page.set_extra_http_headers({"Cache-Control": "no-cache"})
+                logger.info('set Cache-Control use no-cache.')
+            
+            if block_stats is not None:
+                page.on('response', self._on_response)
+
+            if (ignore_resource or save_stack is not None or offline_mode or reject_patterns
+                    or block_stats is not None or cache_stats is not None):
+                page_global_hook = Partial(self.handle_route,
+                                            ignore_resource=ignore_resource, 
+                                            save_stack=save_stack,
+                                            offline_mode=offline_mode,
+                                            reject_patterns=reject_patterns,
+                                            block_stats=block_stats,
+                                            cache_stats=cache_stats)
+
+                await page.route("**/*", page_global_hook)
+                logger.info('hook all request.')
+        except Exception:
+            await self.close_context(context)
+            raise
         
         logger.info('page created.')
 
         return page
     
-    def replace_iframe_element(self, page: Page):
+    @staticmethod
+    def _url_origin(url: str) -> str:
+        parts = urlsplit(url or '')
+        return f'{parts.scheme}://{parts.netloc}'.lower()
+
+    @staticmethod
+    def _frame_depth(frame: Frame) -> int:
+        depth = 0
+        while frame.parent_frame:
+            frame = frame.parent_frame
+            depth += 1
+        return depth
+
+    @staticmethod
+    async def _frame_element_content(frame: Frame):
         """
-        replace iframe element outer_html
+        获取iframe在父页面中的元素以及iframe的页面内容
         """
-        frames_lst = page.frames
-        if len(frames_lst) < 2:
-            return 
+        element, content = await asyncio.gather(frame.frame_element(), frame.content())
+        return element, content
 
-        for frame in frames_lst[1:]:
-            try:
-                content = frame.content()
-                frame_name = frame.name
-                if not frame_name:
+    async def replace_iframe_element(self, page: Page, deadline: float = None, origins: List[str] = None):
+        """
+        将iframe元素替换为iframe的页面内容，包括未命名以及嵌套的iframe
+        1. 同一层的iframe并发获取页面内容，每个父页面一次替换该层所有iframe
+        2. 从最深的一层开始替换，父页面的内容中已包含替换后的子iframe
+        3. 超过 deadline 时不再替换；origins 不为空时只替换指定源的iframe
+        """
+        allowed = {self._url_origin(o) for o in origins} if origins else None
+        levels: Dict[int, List[Frame]] = defaultdict(list)
+        for frame in page.frames[1:]:
+            if frame.is_detached():
+                continue
+            if allowed is not None and self._url_origin(frame.url) not in allowed:
+                continue
+            levels[self._frame_depth(frame)].append(frame)
+
+        for depth in sorted(levels, reverse=True):
+            remaining = deadline - time.time() if deadline else None
+            if remaining is not None and remaining <= 0:
+                logger.warning('iframe replace timeout.')
+                return
+
+            # 超时未返回的iframe不替换，已获取的仍然替换
+            tasks = {asyncio.ensure_future(self._frame_element_content(f)): f for f in levels[depth]}
+            done, pending = await asyncio.wait(tasks, timeout=remaining)
+            for task in pending:
+                task.cancel()
+                logger.warning(f'get iframe content timeout. url: {tasks[task].url}')
+
+            replacements = defaultdict(list)
+            for task in done:
+                frame = tasks[task]
+                if task.exception():
+                    logger.warning(f'get iframe content fail. url: {frame.url}, error: {task.exception()}')
                     continue
-                page.eval_on_selector(f'#{frame_name}', "(e, content) => e.outerHTML=content", content)
-                # page.evaluate(f'(frame) => {{frame.outerHTML = `{content}`;}}', page.query_selector(f'#{frame.name}'))
-            except Exception as e:
-                logger.exception(e)
+                replacements[frame.parent_frame].append(list(task.result()))
 
-    def goto_the_url(self, 
+            remaining = max(deadline - time.time(), 0.1) if deadline else None
+            parents = list(replacements)
+            try:
+                results = await asyncio.wait_for(asyncio.gather(*[
+                    parent.evaluate("(items) => items.forEach(([e, content]) => { e.outerHTML = content })",
+                                    replacements[parent])
+                    for parent in parents
+                ], return_exceptions=True), remaining)
+            except asyncio.TimeoutError:
+                logger.warning('iframe replace timeout.')
+                return
+
+            for parent, result in zip(parents, results):
+                if isinstance(result, Exception):
+                    logger.warning(f'replace iframe fail. url: {parent.url}, error: {result}')
+
+            if pending:
+                return
+
+    @staticmethod
+    async def _wait_for_content(page: Page, deadline: float, **kwargs) -> bool:
+        """
+        等待的内容在超时前未出现时返回False，调用方仍返回当前的页面内容
+        """
+        try:
+            await wait_for_content(page, deadline=deadline, **kwargs)
+        except PlaywrightTimeoutError as e:
+            logger.warning(e)
+            return False
+        return True
+
+    async def goto_the_url(self, 
                     url: str,
                     user_agent: str=None,
                     cookies: Dict[str, str]=None,
@@ -274,11 +522,20 @@ class PlaywrightHandler:
                     save_stack: bool=False,
                     ignore_resource: List[str]=None,
                     wait_for_selector: str=None,
+                    wait_for_text: str=None,
+                    wait_for_regex: str=None,
+                    wait_mode: str='any',
                     exec_js: str=None,
                     exec_js_args: str=None,
                     timeout: int=30,
                     sleep: int=None,
-                    page: Page=None,
+                    settle: bool=False,
+                    settle_quiet: float=0.5,
+                    wait_until: str='load',
+                    offline_mode: bool=False,
+                    reject_request_pattern: List[str]=None,
+                    iframe_origins: List[str]=None,
+                    timer: StageTimer=None,
                     **kwargs):
         """
         跳转到指定的url
@@ -289,95 +546,231 @@ class PlaywrightHandler:
             4. 执行指定js   
             5. 页面级代理  (上下文级代理, 类似于无痕浏览器） 
             6. 是否允许缓存  
-            7. 等待元素  
+            7. 等待元素、字符串或正则匹配结果出现（any/all），出现后立即返回，超时未出现时仍返回页面内容
             8. 请求堆栈  
             9. 忽略资源  
-            10. iframe 标签替换
-
+            10. iframe 标签替换（可按源过滤）
+            11. 等待策略 wait_until ('load', 'domcontentloaded', 'networkidle', 'commit')
+            12. 离线模式，只请求主文档
+            13. 拒绝url匹配正则的请求
+            14. 拦截黑名单中的广告、追踪请求，统计拦截数以及估算节省的流量
+            15. 静态子资源使用共享磁盘缓存（use_cache 为 True 时）
+            16. settle 模式，页面稳定后提前结束 sleep，记录节省的时间
+
+        每次调用使用独立的context，结束后关闭，任务之间不共享页面状态。
+        各阶段耗时记录在返回的 timings 中。
         """
         start_time = time.time()
-        if not self.page:
-            self.page = page
-
-        if not self.page:
-            proxy_fm = None
-            if proxy:
-                proxy_fm = {'server': proxy}
-                
-            self.page: Page = self.get_new_page(
-                user_agent=user_agent,
-                proxy=proxy_fm,
-                cookies=cookies,
-                headers= headers,
-                use_cache=use_cache,
-                save_stack=save_stack,
-                ignore_resource=ignore_resource,
-                **kwargs
-            )
+        timer = timer or StageTimer()
+        timer.reset()
+        proxy_fm = None
+        if proxy:
+            proxy_fm = {'server': proxy}
+
+        reject_patterns = [re.compile(p) for p in reject_request_pattern] if reject_request_pattern else None
+
+        stack = [] if save_stack else None
+        block_stats = {'count': 0, 'bytes_saved': 0} if self.blocklist else None
+        cache_stats = {'hits': 0, 'misses': 0, 'bytes_saved': 0} if self.resource_cache and use_cache else None
+        page: Page = await self.get_new_page(
+            user_agent=user_agent,
+            proxy=proxy_fm,
+            cookies=cookies,
+            headers= headers,
+            use_cache=use_cache,
+            save_stack=stack,
+            ignore_resource=ignore_resource,
+            offline_mode=offline_mode,
+            reject_patterns=reject_patterns,
+            block_stats=block_stats,
+            cache_stats=cache_stats,
+            **kwargs
+        )
             
-        if not self.page:
+        if not page:
             raise Exception("page create fail.")
-        real_timeout = timeout - (time.time()-start_time)
-        if real_timeout < 0:
-            raise Exception("get url timeout.")
-        
-        self.page.goto(url, timeout=real_timeout*1000)
-
-        if sleep and (timeout - (time.time()-start_time)) > 0:
-            time.sleep(sleep)
+        timer.lap('page_create')
 
-        if wait_for_selector and (timeout - (time.time()-start_time)) > 0:
-            self.page.wait_for_selector(wait_for_selector, timeout=timeout*1000)
-        
-        if exec_js and (timeout - (time.time()-start_time)) > 0:
-            self.page.evaluate(exec_js, exec_js_args)
+        tracker, settle_stats = None, None
+        wait_timeout = False
+        if settle and sleep:
+            tracker = NetworkTracker()
+            tracker.attach(page)
 
-        if (timeout - (time.time()-start_time)) > 0:
-            self.replace_iframe_element(self.page)
+        try:
+            real_timeout = timeout - (time.time()-start_time)
+            if real_timeout < 0:
+                raise Exception("get url timeout.")
             
-        content = self.page.content()
-        cookies = self.context.cookies()
-
+            await page.goto(url, timeout=real_timeout*1000, wait_until=wait_until or 'load')
+            timer.lap('goto')
+
+            if tracker and (timeout - (time.time()-start_time)) > 0:
+                waited = await wait_for_settle(page, tracker, quiet=settle_quiet, max_wait=sleep,
+                                               deadline=start_time + timeout)
+                settle_stats = {'sleep': sleep, 'waited': waited, 'saved': max(sleep - waited, 0)}
+                timer.lap('settle')
+            elif sleep and (timeout - (time.time()-start_time)) > 0:
+                await asyncio.sleep(sleep)
+                timer.lap('sleep')
+
+            if wait_for_selector or wait_for_text or wait_for_regex:
+                wait_timeout = not await self._wait_for_content(
+                    page, deadline=start_time + timeout, selector=wait_for_selector, text=wait_for_text,
+                    regex=wait_for_regex, mode=wait_mode)
+                timer.lap('wait_content')
+            
+            if exec_js and (timeout - (time.time()-start_time)) > 0:
+                await page.evaluate(exec_js, exec_js_args)
+                timer.lap('exec_js')
+
+            if (timeout - (time.time()-start_time)) > 0:
+                # 预留获取页面内容的时间
+                await self.replace_iframe_element(page, deadline=start_time + timeout - 0.5, origins=iframe_origins)
+                timer.lap('iframe')
+                
+            content = await page.content()
+            cookies = await page.context.cookies()
+            timer.lap('content')
+        finally:
+            await self.close_page(page)
+            await self.close_context(page.context)
         
         page_data = {
             "content": content,
-            "cookies": cookies
+            "cookies": cookies,
+            "timings": timer.timings,
+            "wait_timeout": wait_timeout,
         }
         if save_stack:
-            page_data['stack'] = self.save_stack
+            page_data['stack'] = stack
+        if block_stats is not None:
+            page_data['blocked'] = block_stats
+        if cache_stats is not None:
+            page_data['resource_cache'] = cache_stats
+        if settle_stats is not None:
+            page_data['settle'] = settle_stats
 
         logger.info('page request finish.')
 
         return page_data
     
-    def close_page(self, page: Page):
+    async def render_content(self,
+                    content: str,
+                    base_url: str=None,
+                    block_subresources: bool=True,
+                    user_agent: str=None,
+                    wait_for_selector: str=None,
+                    wait_for_text: str=None,
+                    wait_for_regex: str=None,
+                    wait_mode: str='any',
+                    exec_js: str=None,
+                    exec_js_args: str=None,
+                    timeout: int=30,
+                    wait_until: str='load',
+                    timer: StageTimer=None,
+                    **kwargs):
+        """
+        离线渲染传入的html，不使用代理、不请求页面
+        1. 没有 base_url 时通过 set_content 加载
+        2. 有 base_url 时跳转到 base_url，主文档请求直接返回传入的html，相对路径的子资源按 base_url 解析
+        3. block_subresources 为 True 时拦截所有子资源请求
+        使用预热的页面，各阶段耗时记录在返回的 timings 中
+        """
+        start_time = time.time()
+        timer = timer or StageTimer()
+        timer.reset()
+
+        page: Page = await self.get_new_page(user_agent=user_agent)
+        timer.lap('page_create')
+
+        served = False
+        wait_timeout = False
+
+        async def handle_render_route(route: Route):
+            nonlocal served
+            if base_url and not served and self._is_main_document(route.request):
+                served = True
+                await route.fulfill(status=200, content_type='text/html; charset=utf-8', body=content)
+            elif block_subresources:
+                await route.abort()
+            else:
+                await route.continue_()
+
         try:
-            page.close()
+            if base_url or block_subresources:
+                await page.route("**/*", handle_render_route)
+
+            real_timeout = (timeout - (time.time() - start_time)) * 1000
+            if base_url:
+                await page.goto(base_url, timeout=real_timeout, wait_until=wait_until or 'load')
+            else:
+                await page.set_content(content, timeout=real_timeout, wait_until=wait_until or 'load')
+            timer.lap('render')
+
+            if wait_for_selector or wait_for_text or wait_for_regex:
+                wait_timeout = not await self._wait_for_content(
+                    page, deadline=start_time + timeout, selector=wait_for_selector, text=wait_for_text,
+                    regex=wait_for_regex, mode=wait_mode)
+                timer.lap('wait_content')
+
+            if exec_js and (timeout - (time.time()-start_time)) > 0:
+                await page.evaluate(exec_js, exec_js_args)
+                timer.lap('exec_js')
+
+            page_content = await page.content()
+            cookies = await page.context.cookies()
+            timer.lap('content')
+        finally:
+            await self.close_page(page)
+            await self.close_context(page.context)
+
+        logger.info('page render finish.')
+
+        return {
+            "content": page_content,
+            "cookies": cookies,
+            "timings": timer.timings,
+            "wait_timeout": wait_timeout,
+        }
+
+    async def close_page(self, page: Page):
+        try:
+            await page.close()
         except:
             logger.warning('page closed.')
             pass
 
-    def close_context(self):
+    async def close_context(self, context: BrowserContext):
         try:
-            self.context.close()
+            await context.close()
         except:
             logger.warning('context closed.')
             pass
     
-    def close_browser(self):
+    async def close_browser(self):
+        for task in list(self._prewarm_tasks.values()):
+            task.cancel()
+        for page in list(self.spare_pages.values()):
+            await self.close_context(page.context)
+        self.spare_pages.clear()
+
         try:
-            self.browser.close()
+            await self.browser.close()
         except:
             logger.warning('browser closed.')
             pass
 
-    def __del__(self):
-        self.close_context()
-        self.close_browser()
+        try:
+            await self.pw.stop()
+        except:
+            logger.warning('playwright stopped.')
+            pass
 
 
-def playwright_test():
+async def playwright_test():
     pw = PlaywrightHandler()
+    await pw.start()
     kwargs = {
         # 'url': 'http://myip.ipip.net',
         'url': 'http://news.e-works.net.cn/category912/news105194.htm',
@@ -389,12 +782,13 @@ def playwright_test():
         # 'timeout': 5,
         # 'sleep': 3,
     }
-    data = pw.goto_the_url(**kwargs)
+    data = await pw.goto_the_url(**kwargs)
     print(data['content'])
+    await pw.close_browser()
 
 
 if __name__ == '__main__':
-    playwright_test()
+    asyncio.run(playwright_test())
     
 
 
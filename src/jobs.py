@@ -0,0 +1,111 @@
+# -*- coding:utf-8 -*-
+
+import time
+import asyncio
+import httpx
+
+from uuid import uuid4
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict
+
+from fastapi import HTTPException
+from loguru import logger
+
+from models import APIRequestModel, APIResponseModel, JobRequestModel, JobResponseModel, JobState
+from exception import NotFoundException, TooManyRequestsException
+from env import JOB_MAX_ITEMS, JOB_TTL, JOB_CONCURRENCY, JOB_CALLBACK_TIMEOUT, JOB_CALLBACK_RETRIES
+
+
+class JobStore:
+    """
+    异步任务，提交后立即返回任务id，通过查询或回调获取结果
+    任务保存在内存中，数量超过上限时淘汰最早完成的任务，完成的任务超过 ttl 后删除
+    """
+
+    def __init__(self, execute: Callable[[APIRequestModel], Awaitable[APIResponseModel]],
+                 max_items=JOB_MAX_ITEMS, ttl=JOB_TTL, concurrency=JOB_CONCURRENCY):
+        self.execute = execute
+        self.max_items = max_items
+        self.ttl = ttl
+        self.jobs: OrderedDict[str, JobResponseModel] = OrderedDict()
+        self.tasks: Dict[str, asyncio.Task] = dict()
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.client: httpx.AsyncClient = None
+
+    def _purge(self):
+        now = time.time()
+        for job_id, job in list(self.jobs.items()):
+            if job.finished_at and now - job.finished_at > self.ttl:
+                self.jobs.pop(job_id, None)
+
+        if len(self.jobs) < self.max_items:
+            return
+        # 超过上限时淘汰最早完成的任务，未完成的任务不淘汰
+        for job_id, job in list(self.jobs.items()):
+            if len(self.jobs) < self.max_items:
+                break
+            if job.finished_at:
+                self.jobs.pop(job_id, None)
+
+    def submit(self, job_req: JobRequestModel) -> JobResponseModel:
+        self._purge()
+        if len(self.jobs) >= self.max_items:
+            raise TooManyRequestsException('未完成的任务过多，请稍后再提交')
+
+        job = JobResponseModel(id=uuid4().hex, url=str(job_req.url), created_at=time.time())
+        self.jobs[job.id] = job
+
+        api_req = APIRequestModel(**{k: getattr(job_req, k) for k in APIRequestModel.model_fields})
+        callback_url = str(job_req.callback_url) if job_req.callback_url else None
+        task = asyncio.create_task(self._run(job, api_req, callback_url))
+        self.tasks[job.id] = task
+        task.add_done_callback(lambda t: self.tasks.pop(job.id, None))
+
+        return job
+
+    def get(self, job_id: str) -> JobResponseModel:
+        job = self.jobs.get(job_id)
+        if job is None or (job.finished_at and time.time() - job.finished_at > self.ttl):
+            raise NotFoundException('任务不存在或已过期')
+        return job
+
+    async def _run(self, job: JobResponseModel, api_req: APIRequestModel, callback_url: str = None):
+        async with self.semaphore:
+            job.state = JobState.running
+            try:
+                job.result = await self.execute(api_req)
+                job.state, job.status_code = JobState.success, 200
+            except HTTPException as e:
+                job.state, job.status_code, job.error = JobState.failed, e.status_code, str(e.detail)
+            except Exception as e:
+                logger.exception(e)
+                job.state, job.status_code, job.error = JobState.failed, 500, str(e)
+            job.finished_at = time.time()
+
+        if callback_url:
+            await self._callback(job, callback_url)
+
+    async def _callback(self, job: JobResponseModel, callback_url: str):
+        if self.client is None:
+            self.client = httpx.AsyncClient(timeout=JOB_CALLBACK_TIMEOUT)
+
+        for retry in range(JOB_CALLBACK_RETRIES):
+            try:
+                resp = await self.client.post(callback_url, content=job.model_dump_json(),
+                                              headers={'Content-Type': 'application/json'})
+                if resp.status_code < 500:
+                    logger.info(f'任务 {job.id} 回调完成，状态码: {resp.status_code}')
+                    return
+                logger.warning(f'任务 {job.id} 回调失败，状态码: {resp.status_code}')
+            except httpx.HTTPError as e:
+                logger.warning(f'任务 {job.id} 回调失败: {e}')
+            if retry < JOB_CALLBACK_RETRIES - 1:
+                await asyncio.sleep(2 ** retry)
+
+        logger.error(f'任务 {job.id} 回调重试 {JOB_CALLBACK_RETRIES} 次后放弃。')
+
+    async def close(self):
+        for task in list(self.tasks.values()):
+            task.cancel()
+        if self.client:
+            await self.client.aclose()
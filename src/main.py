@@ -2,14 +2,11 @@
 import uvicorn
 from loguru import logger
 
-from master import master_start
 from app import app
 from env import PORT
 
 
 def main():
-    master_start()
-
     # 启动参数
     uvicorn.run(app, host="0.0.0.0", port=PORT)
     logger.info('主进程已启动')
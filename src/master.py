@@ -1,299 +1,709 @@
-
-import socket
 import time
-import queue
-import random
-import threading
+import asyncio
 import multiprocessing
 
-from threading import Event, Condition
-from uuid import uuid1
-from typing import Dict
-from dataclasses import dataclass
+from uuid import uuid1, uuid4
+from typing import Dict, Deque, List, Optional, Tuple
+from collections import deque
+from dataclasses import dataclass, field
 from loguru import logger
 
-from utils import generation_sub_md5, get_unused_port, kill_pid
+from utils import generation_sub_md5, context_fingerprint, kill_pid
 from worker import create_worker
-from pipe import ChildPipe, create_process_pipe
+from pipe import ParentPipe, create_process_pipe
 from models import APIRequestModel, APIResponseModel
-from env import MAX_TASK_NUMBER, MAX_TASK_LIVE_TIME, MAX_TASK_IDLE_TIME
+from env import (MAX_TASK_NUMBER, MIN_TASK_NUMBER, MAX_TASK_LIVE_TIME, MAX_TASK_IDLE_TIME, MAX_TASK_REQUESTS,
+                 MAX_WORKER_PAGES, MIN_IDLE_WORKERS, PREWARM, RENDER_MAX_TASK_NUMBER, RENDER_MIN_TASK_NUMBER,
+                 RENDER_MIN_IDLE_WORKERS, RENDER_MAX_WORKER_PAGES, MONITOR_INTERVAL, WORKER_MAX_RSS_MB, WORKER_MAX_CPU_PERCENT,
+                 ADMISSION_MEMORY_RATIO, PROXY_BACKEND, MAX_SPARE_CONTEXTS)
 from exception import InternalException, TimeoutException, HTTPException
-
-
-q_thread = queue.Queue(maxsize=MAX_TASK_NUMBER)
+from metrics import QUEUE_WAIT_SECONDS, STAGE_SECONDS, REQUEST_SECONDS, SCHEDULE_AFFINITY, observe_stages, observe_blocked, \
+    observe_resource_cache, observe_proxy, observe_settle, register_pool_collector, SHM_TRANSFER_BYTES
+from scaler import PoolScaler
+from monitor import ProcessMonitor
+from result_cache import ResultCache
+from forwarder import ForwarderManager, normalize_proxy_url
+from shm import read_content, read_bytes, discard_content, reclaim_segments
+from utils import get_container_memory_limit, get_container_memory_usage
 
 
 class TaskState:
-    busy = 'busy'
-    idle = 'idle'
+    busy = 'busy'  # 没有空闲的页面槽位
+    idle = 'idle'  # 至少有一个空闲的页面槽位
     with_destroyed = 'with-destroyed'
     destroyed = 'destroyed'
     all_state = ['busy', 'idle', 'with-destroyed', 'destroyed']
 
 
-@dataclass
-class Task:
-    pipe: ChildPipe
-    cond: Condition
-    flag: int
-
-
 @dataclass
 class SubprocessInfo:
     task_id: str
     task: multiprocessing.Process
-    pipe: ChildPipe
+    pipe: ParentPipe
     task_state: str
-    task_md5: str
     create_time: int
     update_time: int
+    request_count: int = 0
+    slots: int = 1  # 子进程可同时执行的任务数
+    running: int = 0  # 已发送但尚未返回结果的任务数
+    ready: bool = False  # 子进程浏览器是否已启动完成
+    rss: int = 0  # 进程树内存占用（字节）
+    cpu_percent: float = 0.0  # 进程树CPU占用
+    cpu_over_count: int = 0  # CPU连续超过上限的采样次数
+    futures: Dict[str, asyncio.Future] = field(default_factory=dict)  # request_id -> 等待结果的future
+    warm: Dict[str, float] = field(default_factory=dict)  # 子进程保留的预热context指纹 -> 最近使用时间
+    pending: Dict[str, float] = field(default_factory=dict)  # request_id -> 子进程应返回结果的时间
+    timeout_count: int = 0  # 连续未按时返回结果的任务数
 
 
 class Master:
-    def __init__(self):
-        self.max_task_number = MAX_TASK_NUMBER
+    def __init__(self, name='crawl', max_task_number=MAX_TASK_NUMBER, min_task_number=MIN_TASK_NUMBER,
+                 min_idle_workers=MIN_IDLE_WORKERS, max_worker_pages=MAX_WORKER_PAGES):
+        """
+        name 用于区分不同的子进程池（抓取、离线渲染），各自独立扩缩容
+        """
+        self.name = name
+        self.max_task_number = max_task_number
         self.max_task_live = MAX_TASK_LIVE_TIME
         self.max_task_idle = MAX_TASK_IDLE_TIME
+        self.max_task_requests = MAX_TASK_REQUESTS
+        self.max_worker_pages = max_worker_pages
+        self.max_task_drain = 60  # 标记删除后等待子进程执行完剩余任务的最长时间
+        self.max_task_timeouts = 3  # 连续未按时返回结果的任务数达到该值时回收子进程
+        self.min_idle_workers = min(min_idle_workers, max_task_number)
+        self.prewarm = PREWARM
+        # 与子进程保留的预热context数一致，子进程只在开启预热时保留
+        self.max_warm_contexts = MAX_SPARE_CONTEXTS if PREWARM else 0
+        self.demand_decay = 0.98  # 指纹热度每个管理周期（1秒）的衰减系数
+        self.pool_ready = False  # 最近一次检查时子进程池是否可以接收请求，用于记录状态变化
+        self.scaler = PoolScaler(slots_per_worker=self.max_worker_pages, min_workers=min_task_number,
+                                 max_workers=self.max_task_number)
+        self.result_cache = ResultCache()
+        self.proxy_backend = PROXY_BACKEND
+        self.forwarders = ForwarderManager()
+        # 共用容器资源的其他子进程池，扩容时扣除它们占用的内存以及子进程数
+        self.peers: List['Master'] = []
+
+        self.monitor = ProcessMonitor()
+        self.monitor_interval = MONITOR_INTERVAL
+        self.worker_max_rss = WORKER_MAX_RSS_MB * 1024 * 1024
+        self.worker_max_cpu = WORKER_MAX_CPU_PERCENT
+        self.worker_max_cpu_count = 3  # CPU连续超过上限的采样次数达到该值时回收
+        self.admission_memory_ratio = ADMISSION_MEMORY_RATIO
+        self.admission_paused = False  # 容器内存接近上限时暂停分配新任务
+        self.last_monitor_time = 0
 
         self.subprocess_num = 0
-        self.subprocess_lst: Dict[str, SubprocessInfo] = dict()  # 保留子线程的任务
-        self.thread_lock = threading.RLock()
-        self.thread_lock2 = threading.Lock()
-
-        self.thread_num = 0
-        self.thread_info = dict()
-
-        self.manager_thread = None
-        self.watch_thread = None
+        self.subprocess_lst: Dict[str, SubprocessInfo] = dict()  # 保留子进程的任务
+        # 空闲子进程 task_id -> SubprocessInfo，以及预热context索引 指纹 -> {task_id: SubprocessInfo}
+        self.idle_index: Dict[str, SubprocessInfo] = dict()
+        self.warm_index: Dict[str, Dict[str, SubprocessInfo]] = dict()
+        # 各指纹的请求热度，按时间衰减，用于替换预热context以及缩容时评估代价
+        self.demand: Dict[str, float] = dict()
+        # 等待空闲子进程的请求，先进先出
+        self.waiters: Deque[Tuple[Optional[str], asyncio.Future]] = deque()
+
+        self.loop: asyncio.AbstractEventLoop = None
+        self.manager_task: asyncio.Task = None
 
     def create_subprocess(self, task_id=None):
         """
         创建子进程，并记录子进程信息
+        子进程使用一条常驻管道，结果通过 request_id 匹配
+        子进程发送 ready 后才会被分配任务
         """
         p_pipe, c_pipe = create_process_pipe()
-        unused_port = get_unused_port()
-        task = multiprocessing.Process(target=create_worker, args=(c_pipe, unused_port))
+        task = multiprocessing.Process(target=create_worker,
+                                       args=(c_pipe, self.max_worker_pages, self.prewarm))
         task.start()
 
-        with self.thread_lock:
-            task_id = task_id or str(uuid1())
-            self.subprocess_lst[task_id] = SubprocessInfo(
-                task_id=task_id,
-                task=task,
-                pipe=p_pipe,
-                task_state=TaskState.idle,
-                task_md5=None,
-                create_time=int(time.time()),
-                update_time=int(time.time())
-            )
-            self.subprocess_num = len(self.subprocess_lst)
-
-        return self.subprocess_lst[task_id]
+        task_id = task_id or str(uuid1())
+        task_info = SubprocessInfo(
+            task_id=task_id,
+            task=task,
+            pipe=p_pipe,
+            task_state=TaskState.idle,
+            create_time=int(time.time()),
+            update_time=int(time.time()),
+            slots=self.max_worker_pages,
+        )
+        if self.max_warm_contexts > 0:
+            # 子进程启动时预热默认参数的context
+            task_info.warm[context_fingerprint()] = time.time()
+        self.subprocess_lst[task_id] = task_info
+        self.subprocess_num = len(self.subprocess_lst)
+        self.loop.add_reader(p_pipe.fileno(), self.on_subprocess_message, task_info)
+
+        return task_info
 
     def update_subprocess_status(self, task_id, task_state: str):
+        if task_id not in self.subprocess_lst or task_state not in TaskState.all_state:
+            return False
+
+        task_info = self.subprocess_lst[task_id]
+        self._remove_idle_index(task_info)
+        task_info.task_state = task_state
+        task_info.update_time = int(time.time())
+
+        if task_state == TaskState.idle and task_info.ready:
+            self._add_idle_index(task_info)
+            self._wakeup_waiters()
+
+    def _add_idle_index(self, task_info: SubprocessInfo):
+        self.idle_index[task_info.task_id] = task_info
+        for fingerprint in task_info.warm:
+            self.warm_index.setdefault(fingerprint, dict())[task_info.task_id] = task_info
+
+    def _remove_idle_index(self, task_info: SubprocessInfo):
+        self.idle_index.pop(task_info.task_id, None)
+        for fingerprint in task_info.warm:
+            bucket = self.warm_index.get(fingerprint)
+            if not bucket:
+                continue
+            bucket.pop(task_info.task_id, None)
+            if not bucket:
+                self.warm_index.pop(fingerprint, None)
+
+    def _record_demand(self, fingerprint):
+        self.demand[fingerprint] = self.demand.get(fingerprint, 0) + 1
+
+    def _decay_demand(self):
+        for fingerprint in list(self.demand):
+            self.demand[fingerprint] *= self.demand_decay
+            if self.demand[fingerprint] < 0.01:
+                self.demand.pop(fingerprint)
+
+    def _warm_value(self, task_info: SubprocessInfo) -> float:
+        return sum(self.demand.get(f, 0) for f in task_info.warm)
+
+    def _reset_cost(self, task_info: SubprocessInfo):
+        """
+        没有匹配的预热context时，替换该子进程一个预热context的代价
+        预热context未满时代价为0，否则为热度最低的预热context的热度；相同时选择任务少、内存小的子进程
+        """
+        cost = 0
+        if task_info.warm and len(task_info.warm) >= self.max_warm_contexts:
+            cost = min(self.demand.get(f, 0) for f in task_info.warm)
+        return cost, task_info.running, task_info.rss
 
-        with self.thread_lock:
-            if task_id not in self.subprocess_lst or task_state not in TaskState.all_state:
-                return False
+    def _use_warm(self, task_info: SubprocessInfo, fingerprint):
+        """
+        子进程执行任务后会为该指纹预热context，超过上限时淘汰热度最低的（与子进程的淘汰策略一致）
+        """
+        if self.max_warm_contexts <= 0 or fingerprint is None:
+            return
 
-            self.subprocess_lst[task_id].task_state = task_state
-            self.subprocess_lst[task_id].update_time = int(time.time())
+        indexed = task_info.task_id in self.idle_index
+        self._remove_idle_index(task_info)
+        if fingerprint not in task_info.warm and len(task_info.warm) >= self.max_warm_contexts:
+            victim = min(task_info.warm, key=lambda f: self.demand.get(f, 0))
+            task_info.warm.pop(victim)
+        task_info.warm[fingerprint] = time.time()
+        if indexed:
+            self._add_idle_index(task_info)
 
-    def _manager_subprocess(self):
-        # 管理子进程
-        with self.thread_lock:
-            for task_id, task_info in self.subprocess_lst.items():
-                # 若进程已不存活，且没有标记删除。更新状态删除。
-                if not task_info.task.is_alive() and task_info.task_state != TaskState.destroyed:
-                    logger.info(f'子进程 {task_info.task.pid} 不存活，标记删除。')
-                    self.update_subprocess_status(task_id, TaskState.destroyed)
-                    continue
+    def _pop_idle_subprocess(self, task_md5=None) -> Optional[SubprocessInfo]:
+        """
+        占用一个空闲子进程的页面槽位，槽位用满后标记为忙碌
+        优先选择有相同指纹预热context的子进程；没有时选择替换代价最低的子进程，只替换context不重启子进程
+        """
+        bucket = self.warm_index.get(task_md5)
+        if bucket:
+            task_info = min(bucket.values(), key=lambda t: (t.running, t.rss))
+            SCHEDULE_AFFINITY.labels('warm').inc()
+        elif self.idle_index:
+            task_info = min(self.idle_index.values(), key=self._reset_cost)
+            SCHEDULE_AFFINITY.labels('reset').inc()
+        else:
+            return None
+
+        task_info.running += 1
+        self._use_warm(task_info, task_md5)
+        if task_info.running >= task_info.slots:
+            self.update_subprocess_status(task_info.task_id, TaskState.busy)
+        else:
+            task_info.update_time = int(time.time())
+        return task_info
+
+    def _release_subprocess(self, task_info: SubprocessInfo):
+        """
+        释放一个页面槽位
+        """
+        task_info.running = max(task_info.running - 1, 0)
+        if task_info.task_state == TaskState.busy:
+            self.update_subprocess_status(task_info.task_id, TaskState.idle)
 
-                # 若进程已创建一个小时或20分钟未使用，则标记删除。
-                if ((task_info.create_time < int(time.time()) - self.max_task_live
-                     or task_info.update_time < int(time.time()) - self.max_task_idle)
-                        and task_info.task_state == TaskState.idle):
-                    logger.info(f'子进程 {task_info.task.pid} 已过期，标记删除。')
-                    self.update_subprocess_status(task_id, TaskState.with_destroyed)
-                    continue
+    def _wakeup_waiters(self):
+        """
+        有子进程空闲时，按先进先出顺序唤醒等待的请求
+        """
+        while self.waiters and self.idle_index and not self.admission_paused:
+            task_md5, future = self.waiters.popleft()
+            if future.done():
+                continue
+            future.set_result(self._pop_idle_subprocess(task_md5))
 
-            # kill不存活的子进程
-            # todo 为啥用两个标记删除？
-            need_kill_id = [(task_id, task)
-                            for task_id, task in self.subprocess_lst.items()
-                            if task.task_state in [TaskState.destroyed, TaskState.with_destroyed]]
-
-            if need_kill_id:
-                for task_id, task_info in need_kill_id:
-                    if task_info.task_state == TaskState.with_destroyed:
-                        pid = task_info.task.pid
-                        task_info.pipe.send('kill')
-                        task_info.task.join(1)
-                        kill_pid(pid)
-                        continue
-                    
-                    pid = task_info.task.pid
-                    task_info.task.kill()
-                    task_info.task.join(1)
-                    kill_pid(pid)
-                    self.subprocess_lst.pop(task_id, '')
-                self.subprocess_num = len(self.subprocess_lst)
-
-            is_not_usable = (
-                    len([1 for _, t in self.subprocess_lst.items()
-                         if t.task_state == TaskState.idle]) == 0
-                    and self.subprocess_num < self.max_task_number
-            )
-            if not self.subprocess_lst or is_not_usable:
-                self.create_subprocess()
-
-            logger.info(f'subprocess_num: {self.subprocess_num}')
-
-    def manager_subprocess(self):
-        # 管理子进程
+    def on_subprocess_message(self, task_info: SubprocessInfo):
+        """
+        事件循环回调，读取子进程返回的结果并唤醒对应请求
+        """
         while True:
-            self._manager_subprocess()
-            time.sleep(1)
+            try:
+                message = task_info.pipe.recv()
+            except (EOFError, OSError):
+                self.loop.remove_reader(task_info.pipe.fileno())
+                return
+
+            if message is None:
+                return
+
+            if message == 'ready':
+                logger.info(f'子进程 {task_info.task.pid} 已就绪。')
+                task_info.ready = True
+                if task_info.task_state == TaskState.idle:
+                    self.update_subprocess_status(task_info.task_id, TaskState.idle)
+                self.is_ready()
+                continue
+
+            request_id, res, meta = message
+            task_info.pending.pop(request_id, None)
+            observe_stages(meta.get('timings', {}))
+            observe_blocked(meta.get('blocked'))
+            observe_resource_cache(meta.get('resource_cache'))
+            observe_proxy(meta.get('proxy'))
+            observe_settle(meta.get('settle'))
+            STAGE_SECONDS.labels('ipc').observe(max(time.time() - meta['sent_at'], 0))
+            task_info.request_count += 1
+            if (0 < self.max_task_requests <= task_info.request_count
+                    and task_info.task_state in [TaskState.idle, TaskState.busy]):
+                logger.info(f'子进程 {task_info.task.pid} 已执行 {task_info.request_count} 次任务，标记删除。')
+                self.update_subprocess_status(task_info.task_id, TaskState.with_destroyed)
+            self._release_subprocess(task_info)
+
+            future = task_info.futures.pop(request_id, None)
+            if future is not None:
+                task_info.timeout_count = 0
+            if meta.get('shm'):
+                res = self._read_shm_content(res, meta['shm'], wanted=future is not None and not future.done())
+            if future and not future.done():
+                future.set_result(res)
+
+    @staticmethod
+    def _read_shm_content(res: APIResponseModel, desc: dict, wanted=True):
+        """
+        读取子进程写入共享内存的页面内容，请求已超时或取消时直接删除
+        """
+        if not wanted:
+            discard_content(desc)
+            return res
 
-    def get_one_alive_subprocess(self, timeout=30, task_md5=None):
-        # 获取一个可用的子进程
-        now = time.time()
-        while time.time() < now + timeout:
-            with self.thread_lock:
-                for task_id, task_info in self.subprocess_lst.items():
-                    if task_info.task_state == TaskState.idle and task_info.task_md5 in [task_md5, None]:
-                        self.update_subprocess_status(task_id, TaskState.busy)
-                        # 清空管道
-                        while task_info.pipe.recv(0.01):
-                            continue
-
-                        return task_info
-
-                for task_id, task_info in self.subprocess_lst.items():
-                    if task_info.task_state == TaskState.idle:
-                        task_info.pipe.send('kill')
-                        task_info_ = self.create_subprocess(task_id=task_id)
-                        return task_info_
-
-            time.sleep(random.random() + 0.1)
-        raise InternalException("获取子进程失败")
-    
-    def check_use_thread(self):
-        with self.thread_lock2:
-            if self.thread_num >= self.max_task_number:
-                return False
+        try:
+            if desc.get('field') == 'body':
+                res._body = read_bytes(desc)
             else:
-                self.thread_num += 1
-                return True
+                res.content = read_content(desc)
+        except Exception as e:
+            logger.exception(e)
+            return InternalException("读取页面内容失败")
+        SHM_TRANSFER_BYTES.inc(desc['size'])
+        return res
 
-    def sub_thread(self, task: Task):
-        now = time.time()
+    async def monitor_subprocess(self):
+        """
+        采样子进程资源占用，回收超过上限的子进程，容器内存接近上限时暂停分配新任务
+        """
+        alive_lst = [t for t in self.subprocess_lst.values() if t.task_state in [TaskState.idle, TaskState.busy]]
+        pids = {t.task_id: t.task.pid for t in alive_lst}
+        samples = await self.loop.run_in_executor(None, self.monitor.sample_all, pids)
+
+        for task_info in alive_lst:
+            task_info.rss, task_info.cpu_percent = samples.get(task_info.task_id, (0, 0.0))
+
+            if self.worker_max_cpu and task_info.cpu_percent > self.worker_max_cpu:
+                task_info.cpu_over_count += 1
+            else:
+                task_info.cpu_over_count = 0
+
+            if task_info.rss > self.worker_max_rss:
+                logger.info(f'子进程 {task_info.task.pid} 内存占用 {task_info.rss // 1024 // 1024}MB 超过上限，标记删除。')
+                self.update_subprocess_status(task_info.task_id, TaskState.with_destroyed)
+            elif task_info.cpu_over_count >= self.worker_max_cpu_count:
+                logger.info(f'子进程 {task_info.task.pid} CPU占用 {task_info.cpu_percent:.0f}% 持续超过上限，标记删除。')
+                self.update_subprocess_status(task_info.task_id, TaskState.with_destroyed)
+
+        memory_usage = await self.loop.run_in_executor(None, get_container_memory_usage)
+        memory_limit = get_container_memory_limit()
+        paused = memory_usage >= memory_limit * self.admission_memory_ratio
+        if paused != self.admission_paused:
+            logger.info(f'容器内存占用 {memory_usage // 1024 // 1024}MB / {memory_limit // 1024 // 1024}MB，'
+                        f'{"暂停" if paused else "恢复"}分配新任务。')
+            self.admission_paused = paused
+            if not paused:
+                self._wakeup_waiters()
+
+        if paused:
+            # 回收内存占用最大的空闲子进程，释放内存
+            retire_lst = [t for t in alive_lst
+                          if t.task_state == TaskState.idle and t.running == 0 and t.ready]
+            if retire_lst:
+                task_info = max(retire_lst, key=lambda t: t.rss)
+                logger.info(f'子进程 {task_info.task.pid} 内存占用 {task_info.rss // 1024 // 1024}MB，回收以释放内存。')
+                self.update_subprocess_status(task_info.task_id, TaskState.with_destroyed)
+
+    def worker_memory(self):
+        """
+        已就绪子进程的平均内存占用，没有采样数据时返回None
+        """
+        rss_lst = [t.rss for t in self.subprocess_lst.values() if t.ready and t.rss]
+        if not rss_lst:
+            return None
+        return sum(rss_lst) // len(rss_lst)
 
-        check_status = False
-        while (time.time() - now) < 10:
-            check_status = self.check_use_thread()
-            if check_status:
-                break
-            time.sleep(random.random() + 0.1)
-        
-        if not check_status:
-            task.pipe.send(TimeoutException("线程等待超时"))
+    def resource_usage(self) -> Tuple[int, int]:
+        """
+        子进程池占用的内存（字节，未采样的子进程按平均值或估计值计算）以及子进程数
+        """
+        estimate = self.worker_memory() or self.scaler.worker_memory
+        memory = sum(t.rss or estimate for t in self.subprocess_lst.values())
+        return memory, len(self.subprocess_lst)
+
+    def _peer_usage(self) -> Tuple[int, int]:
+        memory, workers = 0, 0
+        for peer in self.peers:
+            peer_memory, peer_workers = peer.resource_usage()
+            memory += peer_memory
+            workers += peer_workers
+        return memory, workers
+
+    def scale_subprocess(self):
+        """
+        根据扩缩容控制器的目标数，并行扩容或逐个缩容
+        空闲子进程（包括启动中的）少于 min_idle_workers 或没有空闲子进程时也会扩容
+        """
+        self.scaler.tick()
+        alive_lst = [t for t in self.subprocess_lst.values() if t.task_state in [TaskState.idle, TaskState.busy]]
+        idle_lst = [t for t in alive_lst if t.task_state == TaskState.idle]
+        worker_memory = self.worker_memory()
+        reserved_memory, reserved_workers = self._peer_usage()
+        target = self.scaler.target_workers(waiting=len(self.waiters), worker_memory=worker_memory,
+                                            reserved_memory=reserved_memory, reserved_workers=reserved_workers)
+
+        need_num = max(target - len(alive_lst), self.min_idle_workers - len(idle_lst), 0)
+        if not idle_lst:
+            need_num = max(need_num, 1)
+        upper = min(self.max_task_number, self.scaler.resource_limit(worker_memory, reserved_memory, reserved_workers))
+        need_num = min(need_num, upper - self.subprocess_num)
+        if need_num > 0 and not self.admission_paused:
+            logger.info(f'子进程池扩容 {need_num} 个，目标: {target}')
+            self.create_subprocesses(need_num)
             return
 
+        retire_lst = [t for t in idle_lst if t.running == 0 and t.ready]
+        if (len(idle_lst) > self.min_idle_workers and retire_lst
+                and self.scaler.allow_scale_down(len(alive_lst), target)):
+            # 优先回收预热context热度低、内存占用大的子进程
+            task_info = min(retire_lst, key=lambda t: (self._warm_value(t), -t.rss, t.create_time))
+            logger.info(f'子进程 {task_info.task.pid} 缩容，标记删除。')
+            self.update_subprocess_status(task_info.task_id, TaskState.with_destroyed)
+
+    def create_subprocesses(self, num):
+        """
+        并行创建多个子进程，子进程各自启动浏览器
+        """
+        for _ in range(num):
+            self.create_subprocess()
+
+    def is_ready(self):
+        """
+        子进程池是否可以接收请求，用于健康检查
+        每次按当前可用（已就绪且未标记删除）的子进程数判断，子进程回收、缩容或内存不足暂停分配时返回False
+        """
+        ready_num = len([1 for t in self.subprocess_lst.values()
+                         if t.ready and t.task_state in [TaskState.idle, TaskState.busy]])
+        ready = ready_num >= max(self.min_idle_workers, 1) and not self.admission_paused
+        if ready != self.pool_ready:
+            self.pool_ready = ready
+            logger.info(f'{self.name} 子进程池{"已" if ready else "未"}就绪，可用子进程数: {ready_num}，'
+                        f'暂停分配: {self.admission_paused}')
+        return ready
+
+    @staticmethod
+    def kill_subprocess(task_info: SubprocessInfo, graceful=True):
+        pid = task_info.task.pid
+        if graceful:
+            task_info.pipe.send('kill')
+        else:
+            task_info.task.kill()
+        task_info.task.join(1)
+        kill_pid(pid)
+
+    def _fail_subprocess_futures(self, task_info: SubprocessInfo):
+        for future in task_info.futures.values():
+            if not future.done():
+                future.set_exception(InternalException("子进程异常退出"))
+        task_info.futures.clear()
+
+    async def _manager_subprocess(self):
+        # 管理子进程
+        for task_id, task_info in self.subprocess_lst.items():
+            # 若进程已不存活，且没有标记删除。更新状态删除。
+            if not task_info.task.is_alive() and task_info.task_state != TaskState.destroyed:
+                logger.info(f'子进程 {task_info.task.pid} 不存活，标记删除。')
+                self.update_subprocess_status(task_id, TaskState.destroyed)
+                continue
+
+            # 若进程已创建一个小时或20分钟未使用，则标记删除。
+            if ((task_info.create_time < int(time.time()) - self.max_task_live
+                 or (task_info.update_time < int(time.time()) - self.max_task_idle and task_info.running == 0))
+                    and task_info.task_state == TaskState.idle):
+                logger.info(f'子进程 {task_info.task.pid} 已过期，标记删除。')
+                self.update_subprocess_status(task_id, TaskState.with_destroyed)
+                continue
+
+            # 任务超过应返回的时间 max_task_drain 秒仍未返回，子进程已无响应，直接回收
+            if (task_info.pending and task_info.task_state in [TaskState.idle, TaskState.busy]
+                    and min(task_info.pending.values()) < time.time() - self.max_task_drain):
+                logger.info(f'子进程 {task_info.task.pid} 无响应，标记删除。')
+                self.update_subprocess_status(task_id, TaskState.destroyed)
+                continue
+
+        # kill不存活的子进程
+        need_kill_id = [(task_id, task)
+                        for task_id, task in self.subprocess_lst.items()
+                        if task.task_state in [TaskState.destroyed, TaskState.with_destroyed]]
+
+        for task_id, task_info in need_kill_id:
+            if task_info.task_state == TaskState.with_destroyed:
+                # 等待子进程执行完剩余任务后再回收
+                if task_info.running > 0 and task_info.update_time > int(time.time()) - self.max_task_drain:
+                    continue
+                await self.loop.run_in_executor(None, self.kill_subprocess, task_info, True)
+                continue
+
+            self.loop.remove_reader(task_info.pipe.fileno())
+            self._fail_subprocess_futures(task_info)
+            await self.loop.run_in_executor(None, self.kill_subprocess, task_info, False)
+            reclaim_segments(task_info.task.pid)
+            self.subprocess_lst.pop(task_id, '')
+        self.subprocess_num = len(self.subprocess_lst)
+
+        if time.time() - self.last_monitor_time >= self.monitor_interval:
+            self.last_monitor_time = time.time()
+            await self.monitor_subprocess()
+
+        self.scale_subprocess()
+        self._decay_demand()
+        await self.forwarders.evict_idle()
+
+        logger.info(f'{self.name} subprocess_num: {self.subprocess_num}')
+
+    async def manager_subprocess(self):
+        # 管理子进程
+        while True:
+            try:
+                await self._manager_subprocess()
+            except Exception as e:
+                logger.exception(e)
+            await asyncio.sleep(1)
+
+    async def get_one_alive_subprocess(self, timeout=30, task_md5=None):
+        # 获取一个可用的子进程，没有空闲子进程时排队等待唤醒
+        start_time = time.time()
         try:
-            task.cond.acquire()
-            if task.flag == 0:
-                task.cond.wait()
-            task.cond.release()
-            data: APIRequestModel = task.pipe.recv(1)
-            req_timeout = int(data.gotoOptions.timeout / 1000)
-            if not data:
-                raise TimeoutException("线程接收超时")
-
-            task_md5 = generation_sub_md5(data)
-            # 执行data任务
-            subprocess_info: SubprocessInfo = self.get_one_alive_subprocess(task_md5=task_md5, timeout=10)
-            if (time.time() - now) >= req_timeout:
-                raise TimeoutException("子线程已执行超时，不发送给子进程执行任务")
-
-            real_timeout = req_timeout - (time.time() - now)
-            data.gotoOptions.timeout = real_timeout * 1000
-            subprocess_info.pipe.send(data)
-            if not subprocess_info.task_md5:
-                subprocess_info.task_md5 = task_md5
-
-            res: APIResponseModel = subprocess_info.pipe.recv(real_timeout+0.5)
-
-            update_status = TaskState.idle
-            # if not res:
-            #     update_status = TaskState.with_destroyed
-
-            self.update_subprocess_status(subprocess_info.task_id, update_status)
-
-            task.pipe.send(res)
-            pid = subprocess_info.task.pid
-            subprocess_info.pipe.send('kill')
-            subprocess_info.task.join(1)
-            kill_pid(pid)
-        except Exception as e:
+            if not self.waiters and not self.admission_paused:
+                task_info = self._pop_idle_subprocess(task_md5)
+                if task_info:
+                    # 未排队的请求也计入等待时间，扩缩容控制器据此判断排队比例
+                    QUEUE_WAIT_SECONDS.observe(0.0)
+                    self.scaler.record_queue_wait(0.0)
+                    return task_info
+
+            future = self.loop.create_future()
+            self.waiters.append((task_md5, future))
             try:
-                task.pipe.send(e)
-            except:
-                pass
-            
-            logger.exception(e)
+                return await asyncio.wait_for(asyncio.shield(future), timeout)
+            except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+                if future.done() and not future.cancelled():
+                    # 等待结束的同时已被分配子进程，归还
+                    self._release_subprocess(future.result())
+                future.cancel()
+                if isinstance(e, asyncio.CancelledError):
+                    raise
+                raise InternalException("获取子进程失败")
+            finally:
+                queue_wait = time.time() - start_time
+                QUEUE_WAIT_SECONDS.observe(queue_wait)
+                self.scaler.record_queue_wait(queue_wait)
+                logger.info(f'等待子进程耗时: {queue_wait:.3f}s, 排队请求数: {len(self.waiters)}')
+        finally:
+            STAGE_SECONDS.labels('acquire').observe(time.time() - start_time)
+
+    async def execute(self, data: APIRequestModel) -> APIResponseModel:
+        """
+        分发任务给子进程，并等待子进程返回结果
+        """
+        now = time.time()
+        status = 'error'
+        if data._content_encoding and self.result_cache.enabled and data.options.use_result_cache:
+            # 结果缓存保存未压缩的页面内容，由调用方压缩
+            data = data.model_copy()
+            data._content_encoding = None
+        try:
+            res = await self.result_cache.run(data, self._execute)
+            status = 'success'
+            return res
+        except TimeoutException:
+            status = 'timeout'
+            raise
         finally:
-            with self.thread_lock2:
-                self.thread_num -= 1
+            REQUEST_SECONDS.labels(status).observe(time.time() - now)
 
-    def execute(self, task: Task, timeout=30):
+    async def _execute(self, data: APIRequestModel) -> APIResponseModel:
         """
-        创建子线程，并传入Task
+        代理转发方式为gost时，先获取常驻的本地转发，子进程直接使用本地http代理地址
+        代理转发方式为bridge时，子进程收到规范化后的上游代理地址，在子进程内转发
         """
+        now = time.time()
+        self.scaler.record_arrival()
 
-        thread_task = threading.Thread(target=self.sub_thread, args=(task,))
-        thread_task.start()
+        req_timeout = int(data.gotoOptions.timeout / 1000)
+        upstream, proxy = None, None
+        if data.options.request_proxy:
+            proxy = normalize_proxy_url(data.options.request_proxy, data.options.request_proxy_type.value)
 
-    def watch_dog(self):
-        while True:
-            task: Task = q_thread.get()
-            logger.info('获取到api接口任务，准备执行任务。')
-            self.execute(task)
-    
-    def daemon_thread(self):
-        while True:
-            if not self.manager_thread or not self.manager_thread.is_alive():
-                manager_subprocess = threading.Thread(target=self.manager_subprocess)
-                manager_subprocess.start()
-                self.manager_thread = manager_subprocess
-            
-            if not self.watch_thread or not self.watch_thread.is_alive():
-                watch_dog = threading.Thread(target=self.watch_dog)
-                watch_dog.start()
-                self.watch_thread = watch_dog
-            
-            time.sleep(1)
+        if proxy and self.proxy_backend == 'gost':
+            upstream = proxy
+            try:
+                proxy = await asyncio.wait_for(self.forwarders.acquire(upstream), req_timeout)
+            except asyncio.TimeoutError:
+                raise TimeoutException("代理转发启动超时！")
+            STAGE_SECONDS.labels('proxy_setup').observe(time.time() - now)
+
+        try:
+            return await self._dispatch(data, now, proxy)
+        finally:
+            if upstream:
+                self.forwarders.release(upstream)
+
+    async def _dispatch(self, data: APIRequestModel, now: float, proxy: str = None) -> APIResponseModel:
+        req_timeout = int(data.gotoOptions.timeout / 1000)
+        task_md5 = generation_sub_md5(data)
+        if proxy and self.proxy_backend == 'gost':
+            # gost 的本地转发地址可能失效，子进程不为带代理的context预热，不参与预热索引
+            task_md5 = None
+        else:
+            self._record_demand(task_md5)
+        # 执行data任务
+        subprocess_info: SubprocessInfo = await self.get_one_alive_subprocess(
+            task_md5=task_md5, timeout=max(req_timeout - (time.time() - now), 0))
+        if (time.time() - now) >= req_timeout:
+            self._release_subprocess(subprocess_info)
+            raise TimeoutException("任务已执行超时，不发送给子进程执行任务")
+
+        real_timeout = req_timeout - (time.time() - now)
+        data = data.model_copy(deep=True)
+        data.gotoOptions.timeout = real_timeout * 1000
+        if proxy:
+            data.options.request_proxy = proxy
+
+        request_id = uuid4().hex
+        future = self.loop.create_future()
+        subprocess_info.futures[request_id] = future
+        subprocess_info.pending[request_id] = time.time() + real_timeout
+        subprocess_info.pipe.send((request_id, data, time.time()))
+
+        send_time = time.time()
+        try:
+            res: APIResponseModel = await asyncio.wait_for(future, real_timeout + 0.5)
+            self.scaler.record_render(time.time() - send_time)
+        except asyncio.TimeoutError:
+            # 子进程未按时返回，由子进程内的超时关闭该任务的context，不影响同一浏览器中的其他任务
+            # 连续多个任务超时才回收后重建，子进程无响应时由管理任务回收
+            subprocess_info.futures.pop(request_id, None)
+            subprocess_info.timeout_count += 1
+            if (subprocess_info.timeout_count >= self.max_task_timeouts
+                    and subprocess_info.task_state in [TaskState.idle, TaskState.busy]):
+                logger.info(f'子进程 {subprocess_info.task.pid} 连续 {subprocess_info.timeout_count} 个任务超时，标记删除。')
+                self.update_subprocess_status(subprocess_info.task_id, TaskState.with_destroyed)
+            raise TimeoutException("请求超时！")
+
+        if isinstance(res, HTTPException):
+            raise res
+
+        return res
 
     def start(self):
-        # 子进程管理
-        manager_subprocess = threading.Thread(target=self.manager_subprocess)
-        manager_subprocess.start()
-        self.manager_thread = manager_subprocess
+        self.loop = asyncio.get_running_loop()
+        register_pool_collector(self, TaskState.all_state)
 
-        watch_dog = threading.Thread(target=self.watch_dog)
-        watch_dog.start()
-        self.watch_thread = watch_dog
+        if self.prewarm:
+            logger.info(f'预热 {self.min_idle_workers} 个子进程。')
+            self.create_subprocesses(self.min_idle_workers)
 
-        daemon_task = threading.Thread(target=self.daemon_thread)
-        daemon_task.setDaemon(True)
-        daemon_task.start()
+        # 子进程管理
+        self.manager_task = self.loop.create_task(self.manager_subprocess())
 
         logger.info('master 初始化完成。')
 
 
-def master_start():
-    master = Master()
-    master.start()
+    def _stop_subprocess(self, task_info: SubprocessInfo):
+        """
+        通知子进程关闭浏览器后退出，子进程已无法通信时直接结束
+        """
+        try:
+            self.kill_subprocess(task_info, graceful=True)
+        except Exception as e:
+            logger.warning(f'子进程 {task_info.task.pid} 正常退出失败，强制结束: {e}')
+            self.kill_subprocess(task_info, graceful=False)
 
+    async def close(self):
+        """
+        服务退出时停止子进程管理，回收所有子进程及其共享内存，关闭代理转发
+        子进程不是守护进程，不回收时主进程退出会一直等待子进程
+        """
+        if self.manager_task:
+            self.manager_task.cancel()
+            await asyncio.gather(self.manager_task, return_exceptions=True)
+
+        while self.waiters:
+            _, future = self.waiters.popleft()
+            if not future.done():
+                future.set_exception(InternalException("服务正在关闭"))
+
+        task_lst = list(self.subprocess_lst.values())
+        for task_info in task_lst:
+            self.loop.remove_reader(task_info.pipe.fileno())
+            self._fail_subprocess_futures(task_info)
+        await asyncio.gather(*[self.loop.run_in_executor(None, self._stop_subprocess, task_info)
+                               for task_info in task_lst], return_exceptions=True)
+        for task_info in task_lst:
+            reclaim_segments(task_info.task.pid)
+        logger.info(f'{self.name} 子进程已全部回收，数量: {len(task_lst)}')
+
+        self.subprocess_lst.clear()
+        self.idle_index.clear()
+        self.warm_index.clear()
+        self.subprocess_num = 0
+        await self.forwarders.close()
+
+
+master = Master()
+# 离线渲染任务短且不需要代理，使用独立的子进程池，未配置时与抓取共用
+if RENDER_MAX_TASK_NUMBER > 0:
+    render_master = Master(name='render', max_task_number=RENDER_MAX_TASK_NUMBER,
+                           min_task_number=RENDER_MIN_TASK_NUMBER, min_idle_workers=RENDER_MIN_IDLE_WORKERS,
+                           max_worker_pages=RENDER_MAX_WORKER_PAGES)
+    # 两个子进程池共用容器的内存、CPU，各自扩容时扣除对方的占用
+    master.peers.append(render_master)
+    render_master.peers.append(master)
+else:
+    render_master = master
 
 
+def master_start():
+    """
+    需要在事件循环中调用
+    """
+    master.start()
+    if render_master is not master:
+        render_master.start()
@@ -0,0 +1,180 @@
+# -*- coding:utf-8 -*-
+
+from collections import Counter
+from prometheus_client import Histogram, Gauge, Counter as MetricCounter, REGISTRY
+from prometheus_client.core import GaugeMetricFamily
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+QUEUE_WAIT_SECONDS = Histogram(
+    'playwright_api_queue_wait_seconds',
+    '请求等待空闲子进程的时间',
+    buckets=LATENCY_BUCKETS,
+)
+
+# stage:
+#   master: proxy_setup（获取代理转发）, acquire（获取子进程）, ipc（结果传回主进程）
+#   worker: dispatch（发送到子进程开始执行）, page_slot, page_create, goto, sleep, settle, wait_content, exec_js, iframe, content,
+#           compress（/get_content_raw 压缩页面内容）, render（/page_render 加载传入的html）
+STAGE_SECONDS = Histogram(
+    'playwright_api_stage_seconds',
+    '请求各阶段耗时',
+    ['stage'],
+    buckets=LATENCY_BUCKETS,
+)
+
+REQUEST_SECONDS = Histogram(
+    'playwright_api_request_seconds',
+    '请求总耗时',
+    ['status'],
+    buckets=LATENCY_BUCKETS,
+)
+
+SCALER_TARGET_WORKERS = Gauge(
+    'playwright_api_scaler_target_workers',
+    '扩缩容控制器计算的目标子进程数',
+)
+
+SCALER_ARRIVAL_RATE = Gauge(
+    'playwright_api_scaler_arrival_rate',
+    '请求到达率（EWMA，请求/秒）',
+)
+
+BLOCKED_REQUESTS = MetricCounter(
+    'playwright_api_blocked_requests',
+    '黑名单拦截的请求数',
+)
+
+BLOCKED_BYTES = MetricCounter(
+    'playwright_api_blocked_bytes',
+    '黑名单拦截估算节省的流量（字节）',
+)
+
+RESOURCE_CACHE_REQUESTS = MetricCounter(
+    'playwright_api_resource_cache_requests',
+    '子资源缓存请求数',
+    ['result'],
+)
+
+RESOURCE_CACHE_BYTES_SAVED = MetricCounter(
+    'playwright_api_resource_cache_bytes_saved',
+    '子资源缓存命中节省的流量（字节）',
+)
+
+# result: hit, miss, coalesced（等待相同请求的渲染结果）, bypass（未启用或请求不使用缓存）
+RESULT_CACHE_REQUESTS = MetricCounter(
+    'playwright_api_result_cache_requests',
+    '渲染结果缓存请求数',
+    ['result'],
+)
+
+# upstream: 上游代理地址，不包含认证信息
+PROXY_UPSTREAM_CONNECT_SECONDS = Histogram(
+    'playwright_api_proxy_upstream_connect_seconds',
+    '通过上游代理连接目标的耗时',
+    ['upstream'],
+    buckets=LATENCY_BUCKETS,
+)
+
+PROXY_UPSTREAM_ERRORS = MetricCounter(
+    'playwright_api_proxy_upstream_errors',
+    '上游代理连接失败数',
+    ['upstream'],
+)
+
+# result: warm（分配到有相同预热context的子进程）, reset（替换子进程的一个预热context）
+SCHEDULE_AFFINITY = MetricCounter(
+    'playwright_api_schedule_affinity',
+    '任务分配时预热context的命中情况',
+    ['result'],
+)
+
+SHM_TRANSFER_BYTES = MetricCounter(
+    'playwright_api_shm_transfer_bytes',
+    '通过共享内存传回主进程的页面内容大小（字节）',
+)
+
+SETTLE_SAVED_SECONDS = MetricCounter(
+    'playwright_api_settle_saved_seconds',
+    'settle 模式相比固定 sleep 节省的时间',
+)
+
+
+def observe_stages(timings: dict):
+    for stage, seconds in timings.items():
+        STAGE_SECONDS.labels(stage).observe(seconds)
+
+
+def observe_blocked(blocked: dict):
+    if not blocked:
+        return
+    BLOCKED_REQUESTS.inc(blocked['count'])
+    BLOCKED_BYTES.inc(blocked['bytes_saved'])
+
+
+def observe_proxy(stats: dict):
+    if not stats:
+        return
+    for upstream, upstream_stats in stats.items():
+        for seconds in upstream_stats['latencies']:
+            PROXY_UPSTREAM_CONNECT_SECONDS.labels(upstream).observe(seconds)
+        if upstream_stats['errors']:
+            PROXY_UPSTREAM_ERRORS.labels(upstream).inc(upstream_stats['errors'])
+
+
+def observe_settle(stats: dict):
+    if not stats:
+        return
+    SETTLE_SAVED_SECONDS.inc(stats['saved'])
+
+
+def observe_resource_cache(stats: dict):
+    if not stats:
+        return
+    RESOURCE_CACHE_REQUESTS.labels('hit').inc(stats['hits'])
+    RESOURCE_CACHE_REQUESTS.labels('miss').inc(stats['misses'])
+    RESOURCE_CACHE_BYTES_SAVED.inc(stats['bytes_saved'])
+
+
+class PoolCollector:
+    """
+    抓取时读取子进程池状态，避免子进程回收后残留过期的标签
+    """
+
+    def __init__(self, all_state):
+        self.all_state = all_state
+        self.masters = []
+
+    def collect(self):
+        workers = GaugeMetricFamily('playwright_api_workers', '各状态子进程数', labels=['pool', 'state'])
+        running = GaugeMetricFamily('playwright_api_running_tasks', '子进程正在执行的任务数', labels=['pool'])
+        waiting = GaugeMetricFamily('playwright_api_waiting_requests', '等待空闲子进程的请求数', labels=['pool'])
+        paused = GaugeMetricFamily('playwright_api_admission_paused', '是否因内存不足暂停分配新任务', labels=['pool'])
+        rss = GaugeMetricFamily('playwright_api_worker_rss_bytes', '子进程进程树内存占用', labels=['pool', 'pid'])
+        cpu = GaugeMetricFamily('playwright_api_worker_cpu_percent', '子进程进程树CPU占用', labels=['pool', 'pid'])
+
+        for master in self.masters:
+            subprocess_lst = list(master.subprocess_lst.values())
+            state_count = Counter(t.task_state for t in subprocess_lst)
+            for state in self.all_state:
+                workers.add_metric([master.name, state], state_count.get(state, 0))
+            running.add_metric([master.name], sum(t.running for t in subprocess_lst))
+            waiting.add_metric([master.name], len(master.waiters))
+            paused.add_metric([master.name], int(master.admission_paused))
+            for task_info in subprocess_lst:
+                rss.add_metric([master.name, str(task_info.task.pid)], task_info.rss)
+                cpu.add_metric([master.name, str(task_info.task.pid)], task_info.cpu_percent)
+
+        yield from [workers, running, waiting, paused, rss, cpu]
+
+
+_pool_collector: PoolCollector = None
+
+
+def register_pool_collector(master, all_state):
+    global _pool_collector
+    if _pool_collector is None:
+        _pool_collector = PoolCollector(all_state)
+        REGISTRY.register(_pool_collector)
+    _pool_collector.masters.append(master)
@@ -4,8 +4,10 @@
 # @Author : huangkewei
 
 
-from typing import Union, List, Dict
-from pydantic import BaseModel, HttpUrl, Field, field_validator
+import re
+
+from typing import Union, List, Dict, Optional
+from pydantic import BaseModel, HttpUrl, Field, PrivateAttr, field_validator, model_validator
 
 from enum import Enum
 
@@ -34,6 +36,18 @@ class RequestProxyType(str, Enum):
     socks5 = 'socks5'
 
 
+class WaitMode(str, Enum):
+    any = 'any'
+    all = 'all'
+
+
+class ContentEncoding(str, Enum):
+    identity = 'identity'
+    gzip = 'gzip'
+    br = 'br'
+    zstd = 'zstd'
+
+
 class OptionModel(BaseModel):
     headers: dict = Field(None, description='请求头')
     cookies: dict = Field(None, description='cookies')
@@ -41,6 +55,8 @@ class OptionModel(BaseModel):
     timeout: int = Field(30, description='设置访问超时，默认30秒')
     cache_enabled: bool = Field(True, description='是否允许缓存')
     sleep: int = Field(0, description='单位:s。 延迟返回，网页加载完成后等待指定时间执行。')
+    settle: bool = Field(False, description='页面稳定（没有进行中的请求且DOM无变化）后提前返回，sleep 为最长等待时间')
+    settle_quiet: int = Field(500, ge=0, description='单位:ms。settle 模式下请求、DOM持续无变化的时间')
     proxy: Union[dict, str] = Field(None, description='指定代理服务')
     fetch_type: FetchType = Field(FetchType.random,
                                   description='1. 随机分配一台机器请求。 2. 采用本地模式请求')  # todo 本地模式。nginx处理
@@ -51,6 +67,8 @@ class OptionModel(BaseModel):
     searchstr: str = Field(None, description='网页中出现指定字符串才返回，否则一直等待30s')
     restr: str = Field(None, description=' 网页中出现指定正则表达式匹配结果才返回，否则一直等待30s')
     select_expression: str = Field(None, description='出现指定 select 路径，否则一直等待30s')
+    wait_mode: WaitMode = Field(WaitMode.any,
+                                description='searchstr、restr、select_expression 同时指定时，any 任意一个满足即返回，all 全部满足才返回')
     ignore_resource: List[str] = Field(None, description='不加载指定资源')  # todo Selenium 中没有直接忽略资源的方法
     offline_mode: bool = Field(False,
                                description='离线模式。静态网页渲染可尝试设置离线模式，加快返回速度')  # todo 在线和离线有什么区别？
@@ -61,6 +79,7 @@ class OptionModel(BaseModel):
     request_proxy: str = Field(None, description=" 请求代理  '115.216.42.180:31081'，实际使用的代理。")  # 和proxy有啥区别
     request_proxy_type: RequestProxyType = Field(RequestProxyType.http, description="代理类型  http  socks5")
     ignore_proxy_resource: List[str] = Field(None, description=" 忽略代理资源   图片 js  css 默认不走代理")
+    iframe_origins: List[str] = Field(None, description="只替换指定源的iframe，例如 'https://example.com'，为空时全部替换")
 
     # 老版本无头保留，加一个字段可以在nginx进行分流。
 
@@ -70,6 +89,7 @@ class OptionModel(BaseModel):
     data: dict = None
 
     only_cookies: bool = False
+    use_result_cache: bool = Field(True, description='是否使用渲染结果缓存，为False时总是重新渲染')
 
     @field_validator('ignore_resource')
     @classmethod
@@ -93,7 +113,21 @@ class APIRequestModel(BaseModel):
     url: HttpUrl = Field(description='请求网址')
     gotoOptions: GotoOptions = Field(default_factory=GotoOptions, description='goto 选项')
     options: OptionModel = Field(default_factory=OptionModel, description='请求选项')
-    rejectRequestPattern: List = Field(default_factory=list, description='请求选项')
+    rejectRequestPattern: List = Field(default_factory=list, description='拒绝请求的url正则列表')
+    # 内部使用，由 /get_content_raw 根据 Accept-Encoding 设置，子进程按该方式压缩页面内容
+    _content_encoding: Optional[ContentEncoding] = PrivateAttr(None)
+
+    @field_validator('rejectRequestPattern')
+    @classmethod
+    def validate_reject_request_pattern(cls, value: List) -> List:
+        for pattern in value:
+            if not isinstance(pattern, str):
+                raise ValueError(f'Invalid pattern: {pattern}')
+            try:
+                re.compile(pattern)
+            except re.error as e:
+                raise ValueError(f'Invalid pattern: {pattern}, {e}')
+        return value
 
 
 class APIResponseModel(BaseModel):
@@ -106,6 +140,64 @@ class APIResponseModel(BaseModel):
     msg: str = None
     content: str = None
     cookies: dict = None
+    # 内部使用，子进程压缩后的页面内容
+    _body: Optional[bytes] = PrivateAttr(None)
+
+
+class PageRenderRequestModel(APIRequestModel):
+    url: HttpUrl = Field(None, description='基础地址，页面中相对路径的子资源按该地址解析，为空时使用 about:blank')
+    block_subresources: bool = Field(True, description='是否拦截子资源（js、css、图片等）请求，只渲染传入的html')
+
+    @model_validator(mode='after')
+    def validate_content(self):
+        if not self.options.content:
+            raise ValueError('options.content is required')
+        # 离线渲染不使用代理
+        self.options.request_proxy = None
+        self.options.proxy = None
+        return self
+
+
+class BatchFormat(str, Enum):
+    ndjson = 'ndjson'
+    sse = 'sse'
+
+
+class BatchRequestModel(BaseModel):
+    items: List[APIRequestModel] = Field(min_length=1, description='请求列表')
+    concurrency: int = Field(None, ge=1, description='同时执行的请求数，默认使用 BATCH_CONCURRENCY')
+    timeout: int = Field(300000, ge=1, description='整个批次的超时时间，单位毫秒')
+    format: BatchFormat = Field(BatchFormat.ndjson, description='返回格式 ndjson 或 sse')
+
+
+class BatchItemResponseModel(BaseModel):
+    index: int = Field(description='请求在 items 中的位置')
+    url: str
+    status_code: int = 200
+    result: APIResponseModel = None
+    error: str = None
+
+
+class JobRequestModel(APIRequestModel):
+    callback_url: HttpUrl = Field(None, description='任务完成后以POST方式回调该地址，内容与 GET /jobs/{id} 相同')
+
+
+class JobState(str, Enum):
+    pending = 'pending'
+    running = 'running'
+    success = 'success'
+    failed = 'failed'
+
+
+class JobResponseModel(BaseModel):
+    id: str
+    state: JobState = JobState.pending
+    url: str
+    created_at: float
+    finished_at: float = None
+    status_code: int = None
+    result: APIResponseModel = None
+    error: str = None
 
 
 class PlaywrightAPI(BaseModel):
@@ -118,10 +210,19 @@ class PlaywrightAPI(BaseModel):
     save_stack: Union[bool, None] = False
     ignore_resource: Union[List[str], None] = None
     wait_for_selector: Union[str, None] = None
+    wait_for_text: Union[str, None] = None
+    wait_for_regex: Union[str, None] = None
+    wait_mode: Union[str, None] = 'any'
     exec_js: Union[str, None] = None
     exec_js_args: Union[str, None] = None
     sleep: Union[int, None] = 0
+    settle: Union[bool, None] = False
+    settle_quiet: Union[float, None] = 0.5
     timeout: Union[int, float, None] = 30
+    wait_until: Union[str, None] = 'load'
+    offline_mode: Union[bool, None] = False
+    reject_request_pattern: Union[List[str], None] = None
+    iframe_origins: Union[List[str], None] = None
 
 
 def api_request_test():
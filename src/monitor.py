@@ -0,0 +1,57 @@
+# -*- coding:utf-8 -*-
+
+import psutil
+
+from typing import Dict, Tuple
+
+
+class ProcessMonitor:
+    """
+    采样子进程整个进程树（worker、浏览器、gost）的内存以及CPU占用
+    """
+
+    def __init__(self):
+        # 保留psutil.Process对象，cpu_percent需要根据两次采样的差值计算
+        self.processes: Dict[int, psutil.Process] = dict()
+
+    def _get_process(self, pid) -> psutil.Process:
+        process = self.processes.get(pid)
+        if process is None or not process.is_running():
+            process = psutil.Process(pid)
+            self.processes[pid] = process
+        return process
+
+    def sample_tree(self, pid) -> Tuple[int, float]:
+        """
+        返回进程树的 (rss字节数, cpu百分比)
+        """
+        try:
+            root = self._get_process(pid)
+            children = root.children(recursive=True)
+        except psutil.Error:
+            return 0, 0.0
+
+        rss, cpu_percent = 0, 0.0
+        for process in [root] + children:
+            try:
+                process = self._get_process(process.pid)
+                rss += process.memory_info().rss
+                cpu_percent += process.cpu_percent(None)
+            except psutil.Error:
+                continue
+
+        return rss, cpu_percent
+
+    def sample_all(self, pids: Dict[str, int]) -> Dict[str, Tuple[int, float]]:
+        """
+        pids: task_id -> pid
+        """
+        samples = {task_id: self.sample_tree(pid) for task_id, pid in pids.items()}
+        self.prune()
+
+        return samples
+
+    def prune(self):
+        for pid, process in list(self.processes.items()):
+            if not process.is_running():
+                self.processes.pop(pid, None)
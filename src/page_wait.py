@@ -0,0 +1,181 @@
+# -*- coding:utf-8 -*-
+
+import time
+import asyncio
+
+from loguru import logger
+from playwright.async_api import Page, Error as PlaywrightError, TimeoutError as PlaywrightTimeoutError
+
+from models import WaitMode
+
+
+# 在页面中监听DOM变化，条件满足时立即返回true，超时返回false
+# 同一轮事件中的多次变化只检查一次；字符串只检查发生变化的节点的文本，正则才需要序列化整个页面
+WAIT_FOR_CONTENT_JS = '''({selector, text, regex, mode, timeout}) => new Promise((resolve, reject) => {
+    let re = null;
+    if (regex !== null) {
+        try {
+            re = new RegExp(regex);
+        } catch (e) {
+            reject(new Error('invalid restr: ' + e.message));
+            return;
+        }
+    }
+    let textFound = false;
+    const textIn = (node) => {
+        const content = node ? node.textContent : null;
+        return !!content && content.includes(text);
+    };
+    const check = (records) => {
+        const results = [];
+        if (selector !== null) results.push(document.querySelector(selector) !== null);
+        if (text !== null) {
+            if (!textFound) {
+                textFound = records
+                    ? records.some(r => r.type === 'childList' ? textIn(r.target)
+                        : r.type === 'characterData' ? textIn(r.target.parentNode) : false)
+                    : textIn(document.documentElement);
+            }
+            results.push(textFound);
+        }
+        if (re !== null) {
+            results.push(re.test(document.documentElement ? document.documentElement.outerHTML : ''));
+        }
+        return mode === 'all' ? results.every(Boolean) : results.some(Boolean);
+    };
+    if (check(null)) {
+        resolve(true);
+        return;
+    }
+    let pending = [];
+    const observer = new MutationObserver((records) => {
+        const scheduled = pending.length > 0;
+        pending.push(...records);
+        if (scheduled) return;
+        setTimeout(() => {
+            const batch = pending;
+            pending = [];
+            if (check(batch)) {
+                observer.disconnect();
+                clearTimeout(timer);
+                resolve(true);
+            }
+        }, 0);
+    });
+    observer.observe(document, {childList: true, subtree: true, attributes: true, characterData: true});
+    const timer = setTimeout(() => {
+        observer.disconnect();
+        resolve(false);
+    }, timeout);
+})'''
+
+
+async def wait_for_content(page: Page, deadline: float, selector: str = None, text: str = None,
+                           regex: str = None, mode: str = WaitMode.any.value):
+    """
+    等待页面中出现指定的 select 路径、字符串或正则表达式匹配结果，由页面中的 MutationObserver 检测，满足时立即返回
+    字符串在页面文本中匹配，正则在页面HTML中匹配
+    mode 为 any 时任意一个条件满足即返回，为 all 时所有条件同时满足才返回
+    页面跳转导致执行上下文销毁时，在新页面中重新等待；超过 deadline 时抛出超时异常
+    """
+    arg = {'selector': selector, 'text': text, 'regex': regex, 'mode': mode}
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+
+        arg['timeout'] = int(remaining * 1000)
+        try:
+            matched = await asyncio.wait_for(page.evaluate(WAIT_FOR_CONTENT_JS, arg), remaining + 1)
+        except asyncio.TimeoutError:
+            break
+        except PlaywrightError as e:
+            if 'invalid restr' in str(e):
+                raise
+            # 页面跳转中，等待新页面的DOM后重新检测
+            logger.warning(f'wait for content interrupted: {e}')
+            try:
+                await page.wait_for_load_state('domcontentloaded', timeout=max(deadline - time.time(), 0.001) * 1000)
+            except PlaywrightTimeoutError:
+                break
+            await asyncio.sleep(0.05)
+            continue
+
+        if matched:
+            return
+        break
+
+    raise PlaywrightTimeoutError(f'wait for content timeout. selector: {selector}, text: {text}, regex: {regex}')
+
+
+# 记录最近一次DOM变化的时间，返回距今的毫秒数；页面跳转后重新安装
+DOM_IDLE_JS = '''() => {
+    if (!window.__pwSettle) {
+        const state = {last: performance.now()};
+        new MutationObserver(() => { state.last = performance.now(); })
+            .observe(document, {childList: true, subtree: true, attributes: true, characterData: true});
+        window.__pwSettle = state;
+    }
+    return performance.now() - window.__pwSettle.last;
+}'''
+
+
+class NetworkTracker:
+    """
+    记录页面进行中的请求，websocket、eventsource 等长连接不计入
+    """
+    ignore_types = {'websocket', 'eventsource'}
+
+    def __init__(self):
+        self.inflight = set()
+        self.last_activity = time.time()
+
+    def attach(self, page: Page):
+        page.on('request', self._on_request)
+        page.on('requestfinished', self._on_finished)
+        page.on('requestfailed', self._on_finished)
+
+    def _on_request(self, request):
+        if request.resource_type in self.ignore_types:
+            return
+        self.inflight.add(request)
+        self.last_activity = time.time()
+
+    def _on_finished(self, request):
+        if request in self.inflight:
+            self.inflight.discard(request)
+            self.last_activity = time.time()
+
+    def idle_time(self) -> float:
+        if self.inflight:
+            return 0
+        return time.time() - self.last_activity
+
+
+async def wait_for_settle(page: Page, tracker: NetworkTracker, quiet: float, max_wait: float, deadline: float) -> float:
+    """
+    等待页面稳定：没有进行中的请求，且DOM在 quiet 秒内没有变化
+    最多等待 max_wait 秒（即原先固定的 sleep），返回实际等待的时间
+    """
+    start = time.time()
+    end = min(start + max_wait, deadline)
+    while True:
+        remaining = end - time.time()
+        if remaining <= 0:
+            break
+
+        try:
+            dom_idle = await asyncio.wait_for(page.evaluate(DOM_IDLE_JS), remaining) / 1000
+        except asyncio.TimeoutError:
+            break
+        except PlaywrightError as e:
+            # 页面跳转中，视为DOM正在变化
+            logger.warning(f'check dom idle fail: {e}')
+            dom_idle = 0
+
+        idle = min(dom_idle, tracker.idle_time())
+        if idle >= quiet:
+            break
+        await asyncio.sleep(max(min(quiet - idle, end - time.time()), 0.05))
+
+    return time.time() - start
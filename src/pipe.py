@@ -18,6 +18,12 @@ class ParentPipe:
         if self.p_recv.poll(timeout=timeout):
             return self.p_recv.recv()
 
+    def fileno(self):
+        """
+        接收端的文件描述符，用于注册到事件循环
+        """
+        return self.p_recv.fileno()
+
 
 class ChildPipe:
     def __init__(self, c_send, c_recv):
@@ -31,6 +37,12 @@ class ChildPipe:
         if self.c_recv.poll(timeout=timeout):
             return self.c_recv.recv()
 
+    def fileno(self):
+        """
+        接收端的文件描述符，用于注册到事件循环
+        """
+        return self.c_recv.fileno()
+
 
 def create_process_pipe():
     # 父进程发，子进程收
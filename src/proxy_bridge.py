@@ -0,0 +1,406 @@
+# -*- coding:utf-8 -*-
+
+import time
+import base64
+import struct
+import asyncio
+import ipaddress
+
+from collections import deque
+from typing import Deque, Dict, List, Tuple
+from urllib.parse import urlsplit, unquote
+
+from loguru import logger
+
+from env import PROXY_BRIDGE_POOL_SIZE, PROXY_BRIDGE_POOL_IDLE, FORWARDER_IDLE_TIME
+
+
+Connection = Tuple[asyncio.StreamReader, asyncio.StreamWriter]
+
+# 每个上游最多保留的连接耗时样本数，随任务结果发送给主进程后清空
+MAX_LATENCY_SAMPLES = 200
+
+
+class ProxyError(Exception):
+    pass
+
+
+def need_bridge(proxy: str) -> bool:
+    """
+    浏览器可以直接使用不带认证的 http/socks5 代理，带认证的代理需要经过本地转发
+    """
+    parts = urlsplit(proxy)
+    return bool(parts.username or parts.password) or parts.scheme not in ('http', 'socks5')
+
+
+class UpstreamProxy:
+    """
+    上游代理，支持 socks5/socks5h（用户名密码认证）以及 http（Basic认证）
+    """
+
+    def __init__(self, url: str):
+        parts = urlsplit(url)
+        self.scheme = parts.scheme.lower()
+        if self.scheme not in ('socks5', 'socks5h', 'http'):
+            raise ProxyError(f'不支持的代理协议: {self.scheme}')
+
+        self.host = parts.hostname
+        self.port = parts.port or (1080 if self.scheme.startswith('socks5') else 8080)
+        self.username = unquote(parts.username or '')
+        self.password = unquote(parts.password or '')
+        # 统计标签，不包含认证信息
+        self.label = f'{self.scheme}://{self.host}:{self.port}'
+
+    def proxy_authorization(self) -> bytes:
+        if not self.username:
+            return b''
+        token = base64.b64encode(f'{self.username}:{self.password}'.encode('utf-8'))
+        return b'Proxy-Authorization: Basic ' + token + b'\r\n'
+
+    async def open(self) -> Connection:
+        """
+        建立到上游代理的连接，socks5 完成认证，可以放入连接池
+        """
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            if self.scheme.startswith('socks5'):
+                await self._socks5_auth(reader, writer)
+        except Exception:
+            writer.close()
+            raise
+        return reader, writer
+
+    async def _socks5_auth(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        method = 0x02 if self.username else 0x00
+        writer.write(bytes([0x05, 0x01, method]))
+        await writer.drain()
+        ver, chosen = await reader.readexactly(2)
+        if ver != 0x05 or chosen != method:
+            raise ProxyError('socks5 认证方式不支持')
+
+        if method == 0x02:
+            username, password = self.username.encode('utf-8'), self.password.encode('utf-8')
+            writer.write(bytes([0x01, len(username)]) + username + bytes([len(password)]) + password)
+            await writer.drain()
+            _, status = await reader.readexactly(2)
+            if status != 0x00:
+                raise ProxyError('socks5 认证失败')
+
+    async def connect(self, conn: Connection, host: str, port: int):
+        """
+        在已建立的连接上请求连接目标地址
+        """
+        reader, writer = conn
+        if self.scheme.startswith('socks5'):
+            await self._socks5_connect(reader, writer, host, port)
+        else:
+            await self._http_connect(reader, writer, host, port)
+
+    @staticmethod
+    async def _socks5_connect(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, host: str, port: int):
+        try:
+            address = ipaddress.ip_address(host)
+            if address.version == 4:
+                dst = b'\x01' + address.packed
+            else:
+                dst = b'\x04' + address.packed
+        except ValueError:
+            host_bytes = host.encode('idna')
+            dst = b'\x03' + bytes([len(host_bytes)]) + host_bytes
+
+        writer.write(b'\x05\x01\x00' + dst + struct.pack('!H', port))
+        await writer.drain()
+        ver, rep, _, atyp = await reader.readexactly(4)
+        if ver != 0x05 or rep != 0x00:
+            raise ProxyError(f'socks5 连接目标失败, rep: {rep}')
+
+        if atyp == 0x01:
+            await reader.readexactly(4 + 2)
+        elif atyp == 0x04:
+            await reader.readexactly(16 + 2)
+        else:
+            length = (await reader.readexactly(1))[0]
+            await reader.readexactly(length + 2)
+
+    async def _http_connect(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, host: str, port: int):
+        target = f'{host}:{port}'.encode('idna')
+        writer.write(b'CONNECT ' + target + b' HTTP/1.1\r\nHost: ' + target + b'\r\n'
+                     + self.proxy_authorization() + b'\r\n')
+        await writer.drain()
+        head = await reader.readuntil(b'\r\n\r\n')
+        status_line = head.split(b'\r\n', 1)[0].split()
+        if len(status_line) < 2 or status_line[1] != b'200':
+            raise ProxyError(f'http 代理连接目标失败: {head[:100]!r}')
+
+
+class BridgeListener:
+    """
+    本地监听，接收浏览器的 http 代理请求（CONNECT 以及普通http请求），转发到上游代理
+    预先建立并完成认证的上游连接放在连接池中，新请求只需要发送连接目标的命令
+    """
+
+    def __init__(self, upstream: UpstreamProxy, pool_size=PROXY_BRIDGE_POOL_SIZE, pool_idle=PROXY_BRIDGE_POOL_IDLE):
+        self.upstream = upstream
+        self.pool_size = pool_size
+        self.pool_idle = pool_idle
+        self.pool: Deque[Tuple[float, Connection]] = deque()
+        self.filling = False
+        self.closed = False
+        self.server: asyncio.AbstractServer = None
+        self.port = None
+        self.users = 0
+        self.last_used = time.time()
+
+        # 补充连接池以及处理浏览器连接的任务，关闭时取消
+        self.running_tasks = set()
+
+        self.latencies: List[float] = []
+        self.errors = 0
+
+    @property
+    def local_url(self) -> str:
+        return f'http://127.0.0.1:{self.port}'
+
+    async def start(self):
+        # 端口由系统分配，不存在随机端口冲突
+        self.server = await asyncio.start_server(self.handle_client, '127.0.0.1', 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+        self._schedule_fill()
+        logger.info(f'proxy bridge start. port: {self.port}, upstream: {self.upstream.label}')
+
+    async def close(self):
+        self.closed = True
+        if self.server:
+            self.server.close()
+        # 取消进行中的转发，任务退出时关闭浏览器和上游的连接
+        tasks = [task for task in self.running_tasks if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+        while self.pool:
+            _, (_, writer) = self.pool.popleft()
+            writer.close()
+        logger.info(f'proxy bridge close. port: {self.port}, upstream: {self.upstream.label}')
+
+    def _schedule_fill(self):
+        if self.pool_size <= 0 or self.filling:
+            return
+        self.filling = True
+        task = asyncio.get_running_loop().create_task(self._fill_pool())
+        self.running_tasks.add(task)
+        task.add_done_callback(self.running_tasks.discard)
+
+    async def _fill_pool(self):
+        try:
+            while len(self.pool) < self.pool_size and not self.closed:
+                conn = await self.upstream.open()
+                if self.closed:
+                    conn[1].close()
+                    break
+                self.pool.append((time.time(), conn))
+        except Exception as e:
+            logger.warning(f'proxy bridge fill pool fail: {self.upstream.label}, {e}')
+        finally:
+            self.filling = False
+
+    async def _get_connection(self) -> Connection:
+        while self.pool:
+            created, (reader, writer) = self.pool.popleft()
+            if time.time() - created < self.pool_idle and not reader.at_eof() and not writer.is_closing():
+                self._schedule_fill()
+                return reader, writer
+            writer.close()
+
+        self._schedule_fill()
+        return await self.upstream.open()
+
+    async def open_tunnel(self, host: str, port: int) -> Connection:
+        start_time = time.time()
+        try:
+            conn = await self._get_connection()
+            try:
+                await self.upstream.connect(conn, host, port)
+            except Exception:
+                conn[1].close()
+                raise
+        except Exception:
+            self.errors += 1
+            raise
+
+        self._record_latency(start_time)
+        return conn
+
+    def _record_latency(self, start_time: float):
+        if len(self.latencies) < MAX_LATENCY_SAMPLES:
+            self.latencies.append(time.time() - start_time)
+
+    async def handle_client(self, client_reader: asyncio.StreamReader, client_writer: asyncio.StreamWriter):
+        task = asyncio.current_task()
+        self.running_tasks.add(task)
+        upstream_writer = None
+        try:
+            head = await client_reader.readuntil(b'\r\n\r\n')
+            request_line, _, header_block = head.partition(b'\r\n')
+            method, target, version = request_line.decode('latin-1').split(' ', 2)
+
+            on_response = None
+            if method.upper() == 'CONNECT':
+                host, _, port = target.rpartition(':')
+                upstream_reader, upstream_writer = await self.open_tunnel(host.strip('[]'), int(port))
+                client_writer.write(b'HTTP/1.1 200 Connection Established\r\n\r\n')
+                await client_writer.drain()
+            else:
+                start_time = time.time()
+                upstream_reader, upstream_writer = await self._forward_http(method, target, version, header_block)
+                if not self.upstream.scheme.startswith('socks5'):
+                    # http 上游没有单独的连接目标步骤，以收到响应的耗时作为连接耗时
+                    on_response = lambda: self._record_latency(start_time)
+
+            _, received = await asyncio.gather(
+                self._relay(client_reader, upstream_writer),
+                self._relay(upstream_reader, client_writer, on_response),
+            )
+            if on_response and not received:
+                self.errors += 1
+        except (ProxyError, OSError, ValueError, asyncio.IncompleteReadError, asyncio.LimitOverrunError) as e:
+            logger.warning(f'proxy bridge request fail: {self.upstream.label}, {e}')
+            if not client_writer.is_closing():
+                client_writer.write(b'HTTP/1.1 502 Bad Gateway\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+        except asyncio.CancelledError:
+            # 转发关闭时取消，连接在 finally 中关闭
+            pass
+        finally:
+            if upstream_writer:
+                upstream_writer.close()
+            client_writer.close()
+            self.running_tasks.discard(task)
+
+    async def _forward_http(self, method: str, target: str, version: str, header_block: bytes) -> Connection:
+        """
+        普通http请求：socks5 上游建立到目标的隧道后发送 origin-form 请求，http 上游直接转发并附带认证
+        强制 Connection: close，浏览器复用连接时不会把请求发到上一个目标
+        """
+        parts = urlsplit(target)
+        headers = [line for line in header_block.split(b'\r\n')
+                   if line and not line.lower().startswith((b'proxy-', b'connection:', b'keep-alive:'))]
+        headers.append(b'Connection: close')
+
+        if self.upstream.scheme.startswith('socks5'):
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+            conn = await self.open_tunnel(parts.hostname, parts.port or 80)
+            request_line = f'{method} {path} {version}'.encode('latin-1')
+        else:
+            try:
+                conn = await self._get_connection()
+            except Exception:
+                self.errors += 1
+                raise
+            request_line = f'{method} {target} {version}'.encode('latin-1')
+            auth = self.upstream.proxy_authorization()
+            if auth:
+                headers.append(auth.rstrip(b'\r\n'))
+
+        conn[1].write(request_line + b'\r\n' + b'\r\n'.join(headers) + b'\r\n\r\n')
+        return conn
+
+    @staticmethod
+    async def _relay(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, on_first_data=None) -> int:
+        """
+        转发数据直到对端关闭，返回转发的字节数；收到第一块数据时调用 on_first_data
+        """
+        total = 0
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                if on_first_data and not total:
+                    on_first_data()
+                total += len(data)
+                writer.write(data)
+                await writer.drain()
+        except OSError:
+            pass
+        finally:
+            try:
+                if writer.can_write_eof() and not writer.is_closing():
+                    writer.write_eof()
+            except OSError:
+                pass
+        return total
+
+    def pop_stats(self) -> Dict:
+        stats = {'latencies': self.latencies, 'errors': self.errors}
+        self.latencies, self.errors = [], 0
+        return stats
+
+
+class ProxyBridge:
+    """
+    进程内的代理转发，替代gost子进程
+    每个上游代理一个本地监听，按使用者计数，空闲超过 idle_time 后关闭
+    接口与 ForwarderManager 一致：acquire/release/evict_idle/close
+    """
+
+    def __init__(self, idle_time=FORWARDER_IDLE_TIME):
+        self.idle_time = idle_time
+        self.listeners: Dict[str, BridgeListener] = dict()
+        self.locks: Dict[str, asyncio.Lock] = dict()
+
+    async def acquire(self, upstream: str) -> str:
+        lock = self.locks.setdefault(upstream, asyncio.Lock())
+        async with lock:
+            listener = self.listeners.get(upstream)
+            if listener is None:
+                listener = BridgeListener(UpstreamProxy(upstream))
+                await listener.start()
+                self.listeners[upstream] = listener
+
+            listener.users += 1
+            listener.last_used = time.time()
+
+        return listener.local_url
+
+    def release(self, upstream: str):
+        listener = self.listeners.get(upstream)
+        if listener:
+            listener.users = max(listener.users - 1, 0)
+            listener.last_used = time.time()
+
+    async def evict_idle(self) -> List[str]:
+        """
+        关闭空闲超时的转发，返回关闭的本地代理地址
+        """
+        now = time.time()
+        evicted = []
+        for upstream, listener in list(self.listeners.items()):
+            if listener.users > 0 or now - listener.last_used < self.idle_time:
+                continue
+            lock = self.locks.get(upstream)
+            if lock and lock.locked():
+                continue
+            self.listeners.pop(upstream, None)
+            self.locks.pop(upstream, None)
+            await listener.close()
+            evicted.append(listener.local_url)
+
+        return evicted
+
+    async def close(self):
+        for listener in list(self.listeners.values()):
+            await listener.close()
+        self.listeners.clear()
+
+    def pop_stats(self) -> Dict[str, Dict]:
+        """
+        各上游代理的连接耗时以及错误数，读取后清空
+        """
+        stats = dict()
+        for listener in self.listeners.values():
+            listener_stats = listener.pop_stats()
+            if listener_stats['latencies'] or listener_stats['errors']:
+                stats[listener.upstream.label] = listener_stats
+        return stats
@@ -0,0 +1,143 @@
+# -*- coding:utf-8 -*-
+
+import time
+import asyncio
+import hashlib
+
+from email.utils import parsedate_to_datetime
+from typing import Dict
+
+from loguru import logger
+from playwright.async_api import Route
+
+from disk_cache import DiskLRU
+
+
+# 只缓存静态子资源
+CACHEABLE_RESOURCE = {'script', 'stylesheet', 'font', 'image'}
+# 命中缓存时不返回给浏览器的响应头，body已经解压并完整读取
+DROP_HEADERS = {'content-encoding', 'content-length', 'transfer-encoding', 'connection', 'set-cookie'}
+
+
+def parse_cache_control(value: str) -> Dict[str, str]:
+    directives = dict()
+    for item in (value or '').split(','):
+        name, _, arg = item.strip().partition('=')
+        if name:
+            directives[name.lower()] = arg.strip('"')
+    return directives
+
+
+def freshness_lifetime(headers: Dict[str, str]) -> float:
+    """
+    响应的有效期（秒），优先 s-maxage/max-age，其次 Expires
+    """
+    cc = parse_cache_control(headers.get('cache-control'))
+    for name in ('s-maxage', 'max-age'):
+        if cc.get(name, '').isdigit():
+            return int(cc[name])
+
+    if headers.get('expires'):
+        try:
+            expires = parsedate_to_datetime(headers['expires']).timestamp()
+            return max(expires - time.time(), 0)
+        except (TypeError, ValueError):
+            return 0
+
+    return 0
+
+
+def is_storable(status: int, headers: Dict[str, str]) -> bool:
+    if status != 200:
+        return False
+
+    cc = parse_cache_control(headers.get('cache-control'))
+    if 'no-store' in cc or 'private' in cc:
+        return False
+    if 'set-cookie' in headers:
+        return False
+
+    vary = {v.strip().lower() for v in headers.get('vary', '').split(',') if v.strip()}
+    if vary - {'accept-encoding'}:
+        return False
+
+    # 没有有效期也没有验证器时无法判断是否可复用
+    has_validator = 'etag' in headers or 'last-modified' in headers
+    return freshness_lifetime(headers) > 0 or has_validator
+
+
+class ResourceCache:
+    """
+    静态子资源的共享磁盘缓存，通过 page.route 拦截请求并使用 route.fulfill 返回缓存内容
+    以url作为key，保存 etag/last-modified 验证器，过期后带验证器重新请求，304 时继续使用缓存
+    """
+
+    def __init__(self, directory: str, max_bytes: int, max_item_bytes: int):
+        self.lru = DiskLRU(directory, max_bytes, name='resource')
+        self.max_item_bytes = max_item_bytes
+
+    @staticmethod
+    def cache_key(url: str) -> str:
+        return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def is_cacheable_request(request) -> bool:
+        return request.method == 'GET' and request.resource_type in CACHEABLE_RESOURCE
+
+    async def handle(self, route: Route, stats: dict):
+        """
+        返回缓存或者请求网络并写入缓存
+        stats: hits, misses, bytes_saved
+        """
+        request = route.request
+        key = self.cache_key(request.url)
+        try:
+            cached = await asyncio.to_thread(self.lru.get, key)
+        except Exception as e:
+            logger.warning(f'resource cache read fail: {e}')
+            cached = None
+
+        headers = None
+        if cached:
+            meta, body, expires = cached
+            if expires > time.time():
+                await self._fulfill_cached(route, meta, body, stats)
+                return
+
+            # 已过期，带验证器重新请求
+            headers = dict(request.headers)
+            if meta['headers'].get('etag'):
+                headers['if-none-match'] = meta['headers']['etag']
+            if meta['headers'].get('last-modified'):
+                headers['if-modified-since'] = meta['headers']['last-modified']
+
+        response = await route.fetch(headers=headers)
+        if cached and response.status == 304:
+            meta, body, _ = cached
+            meta['headers'].update({k: v for k, v in response.headers.items() if k not in DROP_HEADERS})
+            expires = time.time() + freshness_lifetime(meta['headers'])
+            await asyncio.to_thread(self.lru.update, key, meta, expires)
+            await self._fulfill_cached(route, meta, body, stats)
+            return
+
+        body = await response.body()
+        stats['misses'] += 1
+        await route.fulfill(response=response, body=body)
+
+        resp_headers = response.headers
+        if len(body) <= self.max_item_bytes and is_storable(response.status, resp_headers):
+            meta = {
+                'status': response.status,
+                'headers': {k: v for k, v in resp_headers.items() if k not in DROP_HEADERS},
+            }
+            expires = time.time() + freshness_lifetime(resp_headers)
+            try:
+                await asyncio.to_thread(self.lru.set, key, meta, body, expires)
+            except Exception as e:
+                logger.warning(f'resource cache write fail: {e}')
+
+    @staticmethod
+    async def _fulfill_cached(route: Route, meta: dict, body: bytes, stats: dict):
+        stats['hits'] += 1
+        stats['bytes_saved'] += len(body)
+        await route.fulfill(status=meta['status'], headers=meta['headers'], body=body)
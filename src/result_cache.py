@@ -0,0 +1,165 @@
+# -*- coding:utf-8 -*-
+
+import json
+import time
+import asyncio
+import hashlib
+
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+from loguru import logger
+
+from disk_cache import DiskLRU
+from exception import TimeoutException
+from metrics import RESULT_CACHE_REQUESTS
+from models import APIRequestModel, APIResponseModel
+from env import RESULT_CACHE_TTL, RESULT_CACHE_MEMORY_MB, RESULT_CACHE_DIR, RESULT_CACHE_DISK_MB
+
+
+# 不影响渲染结果的字段，不参与计算key
+KEY_EXCLUDE = {
+    'gotoOptions': {'timeout'},
+    'options': {'timeout', 'use_result_cache'},
+}
+
+
+def result_cache_key(data: APIRequestModel) -> str:
+    """
+    请求参数规范化后计算hash，字段顺序不同的相同请求得到相同的key
+    """
+    param = data.model_dump(mode='json', exclude=KEY_EXCLUDE)
+    param_json = json.dumps(param, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+
+    return hashlib.sha256(param_json.encode('utf-8')).hexdigest()
+
+
+class ResultCache:
+    """
+    渲染结果缓存
+    1. 内存LRU（按内容大小限制），可选磁盘缓存（多个进程共用）
+    2. 相同请求同时到达时只渲染一次，其他请求等待同一个结果（single-flight）
+    3. 只缓存成功的结果，ttl 为0时不启用
+    """
+
+    def __init__(self, ttl=RESULT_CACHE_TTL, max_memory_bytes=RESULT_CACHE_MEMORY_MB * 1024 * 1024,
+                 directory=RESULT_CACHE_DIR, max_disk_bytes=RESULT_CACHE_DISK_MB * 1024 * 1024):
+        self.ttl = ttl
+        self.max_memory_bytes = max_memory_bytes
+        self.memory: OrderedDict[str, Tuple[float, int, APIResponseModel]] = OrderedDict()
+        self.memory_bytes = 0
+        self.disk: Optional[DiskLRU] = None
+        if ttl > 0 and directory:
+            self.disk = DiskLRU(directory, max_disk_bytes, name='result')
+        self.inflight: Dict[str, asyncio.Future] = dict()
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0
+
+    @staticmethod
+    def _size(res: APIResponseModel) -> int:
+        return len(res.content or '') + len(json.dumps(res.cookies or {}))
+
+    def _get_memory(self, key) -> Optional[APIResponseModel]:
+        item = self.memory.get(key)
+        if item is None:
+            return None
+
+        expires, size, res = item
+        if expires <= time.time():
+            self._pop_memory(key)
+            return None
+
+        self.memory.move_to_end(key)
+        return res
+
+    def _pop_memory(self, key):
+        item = self.memory.pop(key, None)
+        if item:
+            self.memory_bytes -= item[1]
+
+    def _set_memory(self, key, res: APIResponseModel, expires: float):
+        size = self._size(res)
+        if size > self.max_memory_bytes:
+            return
+
+        self._pop_memory(key)
+        self.memory[key] = (expires, size, res)
+        self.memory_bytes += size
+        while self.memory_bytes > self.max_memory_bytes:
+            _, (_, old_size, _) = self.memory.popitem(last=False)
+            self.memory_bytes -= old_size
+
+    async def get(self, key) -> Optional[APIResponseModel]:
+        res = self._get_memory(key)
+        if res is not None or self.disk is None:
+            return res
+
+        try:
+            cached = await asyncio.to_thread(self.disk.get, key)
+        except Exception as e:
+            logger.warning(f'result cache read fail: {e}')
+            return None
+        if not cached:
+            return None
+
+        _, body, expires = cached
+        if expires <= time.time():
+            return None
+
+        res = APIResponseModel.model_validate_json(body)
+        self._set_memory(key, res, expires)
+        return res
+
+    async def set(self, key, res: APIResponseModel):
+        expires = time.time() + self.ttl
+        self._set_memory(key, res, expires)
+        if self.disk is None:
+            return
+
+        try:
+            await asyncio.to_thread(self.disk.set, key, {}, res.model_dump_json().encode('utf-8'), expires)
+        except Exception as e:
+            logger.warning(f'result cache write fail: {e}')
+
+    async def _render_and_store(self, key, data: APIRequestModel,
+                                render: Callable[[APIRequestModel], Awaitable[APIResponseModel]]):
+        try:
+            res = await render(data)
+            if res.msg == 'success':
+                await self.set(key, res)
+            return res
+        finally:
+            self.inflight.pop(key, None)
+
+    async def run(self, data: APIRequestModel,
+                  render: Callable[[APIRequestModel], Awaitable[APIResponseModel]]) -> APIResponseModel:
+        """
+        优先返回缓存结果；相同请求正在渲染时等待其结果；否则调用render渲染
+        """
+        if not self.enabled or not data.options.use_result_cache:
+            RESULT_CACHE_REQUESTS.labels('bypass').inc()
+            return await render(data)
+
+        key = result_cache_key(data)
+        res = await self.get(key)
+        if res is not None:
+            RESULT_CACHE_REQUESTS.labels('hit').inc()
+            return res
+
+        task = self.inflight.get(key)
+        if task is None:
+            RESULT_CACHE_REQUESTS.labels('miss').inc()
+            # 渲染在独立的task中执行，发起请求的客户端断开后其他等待者仍可拿到结果
+            task = asyncio.ensure_future(self._render_and_store(key, data, render))
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+            self.inflight[key] = task
+        else:
+            RESULT_CACHE_REQUESTS.labels('coalesced').inc()
+            logger.info('相同请求正在渲染，等待结果。')
+
+        try:
+            return await asyncio.wait_for(asyncio.shield(task), data.gotoOptions.timeout / 1000 + 1)
+        except asyncio.TimeoutError:
+            raise TimeoutException("请求超时！")
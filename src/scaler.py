@@ -0,0 +1,130 @@
+# -*- coding:utf-8 -*-
+
+import math
+import time
+
+from loguru import logger
+
+from utils import get_container_memory_limit, get_container_cpu_limit
+from metrics import SCALER_TARGET_WORKERS, SCALER_ARRIVAL_RATE
+from env import (MIN_TASK_NUMBER, MAX_TASK_NUMBER, SCALE_HEADROOM, SCALE_DOWN_DELAY,
+                 WORKER_MEMORY_MB, MEMORY_LIMIT_RATIO, WORKERS_PER_CPU)
+
+
+class Ewma:
+    """
+    指数加权移动平均
+    """
+
+    def __init__(self, alpha=0.2, value=0.0):
+        self.alpha = alpha
+        self.value = value
+        self.initialized = False
+
+    def update(self, value):
+        if not self.initialized:
+            self.value = value
+            self.initialized = True
+        else:
+            self.value = self.alpha * value + (1 - self.alpha) * self.value
+        return self.value
+
+
+class PoolScaler:
+    """
+    子进程池扩缩容控制器
+    根据请求到达率、排队时间、渲染耗时（EWMA）计算目标子进程数，并受容器CPU、内存限制
+    """
+
+    def __init__(self, slots_per_worker=1, min_workers=MIN_TASK_NUMBER, max_workers=MAX_TASK_NUMBER):
+        self.slots_per_worker = max(slots_per_worker, 1)
+        self.min_workers = min(min_workers, max_workers)
+        self.max_workers = max_workers
+        self.headroom = SCALE_HEADROOM
+        self.scale_down_delay = SCALE_DOWN_DELAY
+        self.worker_memory = WORKER_MEMORY_MB * 1024 * 1024
+        self.memory_limit_ratio = MEMORY_LIMIT_RATIO
+        self.workers_per_cpu = WORKERS_PER_CPU
+        self.max_queue_wait = 0.5  # 平均排队时间超过该值时额外扩容一个子进程
+
+        self.arrival_rate = Ewma(alpha=0.3)  # 请求/秒
+        self.queue_wait = Ewma()  # 秒
+        self.render_time = Ewma()  # 秒
+
+        self.arrivals = 0
+        self.last_tick = time.time()
+        self.scale_down_since = None
+
+    def record_arrival(self):
+        self.arrivals += 1
+
+    def record_queue_wait(self, seconds):
+        self.queue_wait.update(seconds)
+
+    def record_render(self, seconds):
+        self.render_time.update(seconds)
+
+    def tick(self):
+        """
+        每个管理周期调用一次，更新请求到达率
+        """
+        now = time.time()
+        interval = max(now - self.last_tick, 1e-3)
+        self.arrival_rate.update(self.arrivals / interval)
+        if not self.arrivals:
+            # 没有新请求时排队时间逐渐回落
+            self.queue_wait.update(0)
+        self.arrivals = 0
+        self.last_tick = now
+        SCALER_ARRIVAL_RATE.set(self.arrival_rate.value)
+
+    def resource_limit(self, worker_memory=None, reserved_memory=0, reserved_workers=0) -> int:
+        """
+        根据容器CPU、内存限制计算最多可运行的子进程数
+        worker_memory 单个子进程的实际内存占用（字节），未知时使用配置的估计值
+        reserved_memory、reserved_workers 为共用容器资源的其他子进程池占用的内存（字节）以及子进程数
+        """
+        worker_memory = worker_memory or self.worker_memory
+        memory_budget = get_container_memory_limit() * self.memory_limit_ratio - reserved_memory
+        max_by_memory = int(memory_budget // worker_memory)
+        max_by_cpu = math.ceil(get_container_cpu_limit() * self.workers_per_cpu) - reserved_workers
+        return max(min(max_by_memory, max_by_cpu), 1)
+
+    def target_workers(self, waiting=0, worker_memory=None, reserved_memory=0, reserved_workers=0) -> int:
+        """
+        计算目标子进程数
+        利特尔法则：并发任务数 = 到达率 * 渲染耗时，排队中的请求也需要额外的槽位
+        """
+        slots_needed = self.arrival_rate.value * self.render_time.value + waiting
+        workers = math.ceil(slots_needed * self.headroom / self.slots_per_worker)
+        if self.queue_wait.value > self.max_queue_wait:
+            workers += 1
+
+        upper = min(self.max_workers, self.resource_limit(worker_memory, reserved_memory, reserved_workers))
+        target = max(min(workers, upper), min(self.min_workers, upper))
+        SCALER_TARGET_WORKERS.set(target)
+
+        return target
+
+    def allow_scale_down(self, current, target) -> bool:
+        """
+        目标数持续低于当前数超过 scale_down_delay 秒后才允许缩容，避免抖动
+        """
+        if target >= current:
+            self.scale_down_since = None
+            return False
+
+        now = time.time()
+        if self.scale_down_since is None:
+            self.scale_down_since = now
+            return False
+
+        if now - self.scale_down_since < self.scale_down_delay:
+            return False
+
+        # 每次缩容一个子进程后重新计时
+        self.scale_down_since = now
+        logger.info(f'子进程池缩容，当前: {current}, 目标: {target}, '
+                    f'到达率: {self.arrival_rate.value:.2f}/s, 渲染耗时: {self.render_time.value:.2f}s, '
+                    f'排队耗时: {self.queue_wait.value:.2f}s')
+        return True
@@ -0,0 +1,140 @@
+# -*- coding:utf-8 -*-
+
+import os
+import errno
+
+from uuid import uuid4
+from typing import Optional
+from multiprocessing import shared_memory, resource_tracker
+
+from loguru import logger
+
+from env import SHM_TRANSFER_MIN_KB
+
+SHM_DIR = '/dev/shm'
+
+
+def _segment_prefix(pid: int) -> str:
+    return f'pwapi_{pid}_'
+
+
+def write_content(content: str) -> Optional[dict]:
+    """
+    子进程将较大的页面内容写入共享内存，管道中只传递描述信息 {'name', 'size'}
+    内容小于阈值、未启用或写入失败（例如 /dev/shm 空间不足）时返回None，仍通过管道传递
+    共享内存由主进程读取后删除，子进程不再跟踪
+    """
+    if SHM_TRANSFER_MIN_KB <= 0 or not content or len(content) < SHM_TRANSFER_MIN_KB * 1024:
+        return None
+
+    return write_bytes(content.encode('utf-8'))
+
+
+def _reserve(shm: shared_memory.SharedMemory, size: int):
+    """
+    为共享内存分配实际的空间，空间不足时抛出 OSError
+    """
+    if hasattr(os, 'posix_fallocate'):
+        os.posix_fallocate(shm._fd, 0, size)
+        return
+
+    stat = os.statvfs(SHM_DIR)
+    if stat.f_bavail * stat.f_frsize < size:
+        raise OSError(errno.ENOSPC, f'{SHM_DIR} 剩余空间不足 {size} 字节')
+
+
+def write_bytes(data: bytes) -> Optional[dict]:
+    """
+    与 write_content 相同，用于压缩后的页面内容
+    """
+    if SHM_TRANSFER_MIN_KB <= 0 or len(data) < SHM_TRANSFER_MIN_KB * 1024:
+        return None
+
+    name = _segment_prefix(os.getpid()) + uuid4().hex[:16]
+    try:
+        shm = shared_memory.SharedMemory(name=name, create=True, size=len(data))
+    except OSError as e:
+        logger.warning(f'共享内存创建失败，通过管道传递结果: {e}')
+        return None
+
+    # tmpfs 上创建只是截断出稀疏文件，空间不足时写入映射会触发 SIGBUS 导致子进程崩溃，写入前先分配空间
+    try:
+        _reserve(shm, len(data))
+    except OSError as e:
+        shm.close()
+        shm.unlink()
+        logger.warning(f'共享内存空间不足，通过管道传递结果: {e}')
+        return None
+
+    try:
+        shm.buf[:len(data)] = data
+    except Exception:
+        shm.close()
+        shm.unlink()
+        raise
+
+    # 子进程退出时 resource_tracker 会删除未注销的共享内存，由主进程负责删除
+    resource_tracker.unregister(shm._name, 'shared_memory')
+    shm.close()
+
+    return {'name': name, 'size': len(data)}
+
+
+def read_content(desc: dict) -> str:
+    """
+    主进程读取共享内存中的页面内容，解码为字符串（复制一次）后删除
+    """
+    shm = shared_memory.SharedMemory(name=desc['name'])
+    try:
+        buf = shm.buf[:desc['size']]
+        try:
+            return str(buf, 'utf-8')
+        finally:
+            buf.release()
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def read_bytes(desc: dict) -> bytes:
+    shm = shared_memory.SharedMemory(name=desc['name'])
+    try:
+        return bytes(shm.buf[:desc['size']])
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def discard_content(desc: dict):
+    """
+    请求已超时或取消，不读取直接删除
+    """
+    try:
+        shm = shared_memory.SharedMemory(name=desc['name'])
+    except FileNotFoundError:
+        return
+    shm.close()
+    shm.unlink()
+
+
+def reclaim_segments(pid: int) -> int:
+    """
+    子进程退出后删除其遗留的共享内存（已写入但主进程未读取的结果），返回删除的数量
+    """
+    if not os.path.isdir(SHM_DIR):
+        return 0
+
+    prefix = _segment_prefix(pid)
+    count = 0
+    for name in os.listdir(SHM_DIR):
+        if not name.startswith(prefix):
+            continue
+        try:
+            os.unlink(os.path.join(SHM_DIR, name))
+            count += 1
+        except FileNotFoundError:
+            pass
+
+    if count:
+        logger.info(f'回收子进程 {pid} 遗留的共享内存 {count} 个。')
+    return count
@@ -0,0 +1,90 @@
+# -*- coding:utf-8 -*-
+
+from functools import lru_cache
+from typing import List, Optional, Tuple
+
+from loguru import logger
+from pjstealth import StealthConfig
+from pjstealth.stealth import SCRIPTS
+
+
+class StealthProfile:
+    default = 'default'  # pjstealth 全部伪造 + 自定义伪造
+    minimal = 'minimal'  # 只使用自定义伪造
+    off = 'off'  # 不伪造
+    all_profile = ['default', 'minimal', 'off']
+
+
+# 自定义伪造，原先在页面创建后通过 page.evaluate 执行
+CUSTOM_EVASIONS = [
+    '''Object.defineProperty(navigator, 'webdriver', {get: () => false});''',
+    '''
+    const originalQuery = window.navigator.permissions.query;
+    window.navigator.permissions.query = (parameters) => (
+        parameters.name === 'notifications' ?
+            Promise.resolve({state: Notification.permission}) :
+            originalQuery(parameters)
+    );
+    ''',
+    # pjstealth 在没有插件时会伪造完整的 PluginArray，只在仍为空时兜底
+    '''
+    if (!navigator.plugins || !navigator.plugins.length) {
+        Object.defineProperty(navigator, 'plugins', {get: () => [1, 2, 3, 4, 5]});
+    }
+    ''',
+]
+
+# pjstealth 中定义公共变量、函数的脚本，其余脚本依赖它们，不能放在独立的块中；按内容识别，不依赖顺序
+_SHARED_SCRIPT_NAMES = ['utils', 'generate_magic_arrays']
+
+
+def _split_shared(pj_scripts: List[str]) -> Tuple[List[str], List[str]]:
+    """
+    拆分出公共定义（const opts、utils、generate_magic_arrays）以及各个伪造
+    缺少公共定义时所有伪造都会在页面中报错，直接抛出异常而不是生成无效的脚本
+    """
+    shared_scripts = [SCRIPTS[name] for name in _SHARED_SCRIPT_NAMES]
+    opts = [s for s in pj_scripts if s.startswith('const opts')]
+    missing = [name for name, script in zip(_SHARED_SCRIPT_NAMES, shared_scripts) if script not in pj_scripts]
+    if not opts:
+        missing.append('opts')
+    if missing:
+        raise RuntimeError(f'pjstealth shared scripts not found: {missing}')
+
+    shared = opts + shared_scripts
+    evasions = [s for s in pj_scripts if s not in shared]
+    return shared, evasions
+
+
+def _isolate(script: str) -> str:
+    # 每个伪造在独立的块中执行，变量互不冲突，单个伪造出错不影响其他伪造
+    return f'try {{\n{script}\n}} catch (e) {{}}'
+
+
+@lru_cache(maxsize=32)
+def build_stealth_script(profile: str, user_agent: str) -> Optional[str]:
+    """
+    将一个 profile 的所有伪造合并为一个脚本，每个子进程按 (profile, user_agent) 只生成一次
+    通过 context.add_init_script 注册，在页面自身脚本之前执行
+    """
+    if profile == StealthProfile.off:
+        return None
+
+    scripts = []
+    if profile == StealthProfile.default:
+        # navigator_platform 由 pjstealth 根据 user_agent 推断，非 Chrome 的 user_agent 无法推断，只使用自定义伪造
+        try:
+            pj_scripts = list(StealthConfig(navigator_user_agent=user_agent, navigator_platform=None).enabled_scripts)
+        except Exception as e:
+            logger.warning(f'pjstealth config fail, use minimal. user_agent: {user_agent}, error: {e}')
+            pj_scripts = []
+        if pj_scripts:
+            shared, evasions = _split_shared(pj_scripts)
+            scripts.extend(shared)
+            scripts.extend(_isolate(s) for s in evasions)
+    elif profile != StealthProfile.minimal:
+        logger.warning(f'stealth profile not find: {profile}. use minimal')
+
+    scripts.extend(_isolate(s) for s in CUSTOM_EVASIONS)
+
+    return '(() => {\n' + '\n;\n'.join(scripts) + '\n})();'
@@ -3,15 +3,32 @@
 # @Time   : 2023/10/31 09:44
 # @Author : huangkewei
 
+import time
 import random
 import socket
 import json
 import hashlib
 import psutil
 
-from loguru import logger
+from models import APIRequestModel, APIResponseModel, PlaywrightAPI, WaitUntil, PageRenderRequestModel
 
-from models import APIRequestModel, APIResponseModel, PlaywrightAPI
+
+# puppeteer 的 networkidle0/networkidle2 在playwright中只有 networkidle
+PW_WAIT_UNTIL = {
+    WaitUntil.load: 'load',
+    WaitUntil.dom_content_loaded: 'domcontentloaded',
+    WaitUntil.network_idle_0: 'networkidle',
+    WaitUntil.network_idle_2: 'networkidle',
+}
+
+
+def get_wait_until(req: APIRequestModel) -> str:
+    # gotoOptions.waitUntil 优先，未指定时使用 options.wait_until
+    wait_until = req.options.wait_until
+    if 'waitUntil' in req.gotoOptions.model_fields_set:
+        wait_until = req.gotoOptions.waitUntil
+
+    return PW_WAIT_UNTIL.get(wait_until, 'load')
 
 
 def api_request_to_pw_api(req: APIRequestModel) -> PlaywrightAPI:
@@ -32,10 +49,19 @@ def api_request_to_pw_api(req: APIRequestModel) -> PlaywrightAPI:
         'save_stack': req.options.print_stack,
         'ignore_resource': req.options.ignore_resource,
         'wait_for_selector': req.options.select_expression,
+        'wait_for_text': req.options.searchstr,
+        'wait_for_regex': req.options.restr,
+        'wait_mode': req.options.wait_mode.value,
         'exec_js': req.options.code,
         'exec_js_args': req.options.context or None,
         'sleep': int(req.options.sleep / 1000),
+        'settle': req.options.settle,
+        'settle_quiet': req.options.settle_quiet / 1000,
         'timeout': int(req.gotoOptions.timeout / 1000),
+        'wait_until': get_wait_until(req),
+        'offline_mode': req.options.offline_mode,
+        'reject_request_pattern': req.rejectRequestPattern or None,
+        'iframe_origins': req.options.iframe_origins or None,
     }
 
     pw_api = PlaywrightAPI(**json_data)
@@ -43,9 +69,31 @@ def api_request_to_pw_api(req: APIRequestModel) -> PlaywrightAPI:
     return pw_api
 
 
+def page_render_request_to_kwargs(req: PageRenderRequestModel) -> dict:
+    # 离线渲染的参数，不包含代理以及网络相关的参数
+    return {
+        'content': req.options.content,
+        'base_url': str(req.url) if req.url else None,
+        'block_subresources': req.block_subresources,
+        'user_agent': req.options.user_agent,
+        'wait_for_selector': req.options.select_expression,
+        'wait_for_text': req.options.searchstr,
+        'wait_for_regex': req.options.restr,
+        'wait_mode': req.options.wait_mode.value,
+        'exec_js': req.options.code,
+        'exec_js_args': req.options.context or None,
+        'timeout': int(req.gotoOptions.timeout / 1000),
+        'wait_until': get_wait_until(req),
+    }
+
+
 def req_res_to_api_res(res: dict) -> APIResponseModel:
+    msg = 'success' if res['content'] else 'err'
+    if res['content'] and res.get('wait_timeout'):
+        # 等待的元素、字符串或正则匹配结果超时未出现，仍返回页面内容；不会写入结果缓存
+        msg = 'wait content timeout'
     json_data = {
-        'msg': 'success' if res['content'] else 'err',
+        'msg': msg,
         'content': res['content'],
         'cookies': {d['name']: d['value'] for d in res['cookies']},
     }
@@ -55,23 +103,40 @@ def req_res_to_api_res(res: dict) -> APIResponseModel:
     return api_res
 
 
-def generation_sub_md5(data: APIRequestModel) -> str:
-    main_param = {
-        'user_agent': data.options.user_agent,
-        'cookies': data.options.cookies,
-        'headers': data.options.headers,
-        # 'proxy': data.options.request_proxy,
-        'proxy': True if data.options.request_proxy else False,
-        'use_cache': data.options.cache_enabled,
-        'save_stack': data.options.print_stack,
-        'ignore_resource': data.options.ignore_resource,
-    }
-    main_json = json.dumps(main_param)
+class StageTimer:
+    """
+    记录请求各阶段耗时（秒）
+    """
+
+    def __init__(self):
+        self.timings = dict()
+        self.mark = time.time()
+
+    def reset(self):
+        self.mark = time.time()
+
+    def lap(self, stage):
+        now = time.time()
+        self.timings[stage] = self.timings.get(stage, 0) + now - self.mark
+        self.mark = now
+
+
+def context_fingerprint(user_agent: str = None, proxy: str = None) -> str:
+    """
+    context 创建后不能修改的参数，子进程按此保留预热的context
+    cookies、headers、资源拦截等在页面创建后设置，不参与计算
+    """
+    main_json = json.dumps({'user_agent': user_agent or '', 'proxy': proxy or ''})
     md5_string = hashlib.md5(main_json.encode('utf-8')).hexdigest()
 
     return md5_string
 
 
+def generation_sub_md5(data: APIRequestModel) -> str:
+    # 代理设置在每个任务的context上，不同代理可以同时使用，相同代理优先分配给已有预热context的子进程
+    return context_fingerprint(data.options.user_agent, data.options.request_proxy)
+
+
 def get_unused_port():
     while True:
         port = random.randint(10000, 20000)  # 选择一个随机端口号
@@ -92,10 +157,74 @@ def kill_pid(pid):
     if not check_pid_exist(pid):
         return
     p = psutil.Process(pid)
-    p.terminal()
+    p.terminate()
     p.wait()
 
 
+def _read_cgroup_file(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def get_container_memory_limit() -> int:
+    """
+    容器内存上限（字节），优先读取cgroup限制，否则使用机器物理内存
+    """
+    total = psutil.virtual_memory().total
+    for path in ['/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes']:
+        value = _read_cgroup_file(path)
+        if value and value.isdigit() and int(value) < total:
+            return int(value)
+
+    return total
+
+
+def get_container_memory_usage() -> int:
+    """
+    容器已使用内存（字节），优先读取cgroup统计（扣除可回收的文件缓存），否则使用机器已使用内存
+    """
+    for usage_path, stat_path, stat_key in [
+        ('/sys/fs/cgroup/memory.current', '/sys/fs/cgroup/memory.stat', 'inactive_file'),
+        ('/sys/fs/cgroup/memory/memory.usage_in_bytes', '/sys/fs/cgroup/memory/memory.stat', 'total_inactive_file'),
+    ]:
+        value = _read_cgroup_file(usage_path)
+        if not value or not value.isdigit():
+            continue
+
+        inactive_file = 0
+        for line in (_read_cgroup_file(stat_path) or '').splitlines():
+            key, _, num = line.partition(' ')
+            if key == stat_key and num.isdigit():
+                inactive_file = int(num)
+                break
+
+        return max(int(value) - inactive_file, 0)
+
+    return psutil.virtual_memory().used
+
+
+def get_container_cpu_limit() -> float:
+    """
+    容器可用CPU核数，优先读取cgroup限制，否则使用机器CPU核数
+    """
+    cpu_count = psutil.cpu_count() or 1
+    value = _read_cgroup_file('/sys/fs/cgroup/cpu.max')
+    if value:
+        quota, _, period = value.partition(' ')
+        if quota.isdigit() and period.isdigit():
+            return min(int(quota) / int(period), cpu_count)
+
+    quota = _read_cgroup_file('/sys/fs/cgroup/cpu/cpu.cfs_quota_us')
+    period = _read_cgroup_file('/sys/fs/cgroup/cpu/cpu.cfs_period_us')
+    if quota and period and quota.isdigit() and period.isdigit():
+        return min(int(quota) / int(period), cpu_count)
+
+    return cpu_count
+
+
 def worker_test_3():
     json_data = {
         'url': 'https://sdbhgj.youzhicai.com/index/Notice.html?id=2ed513c0-bc27-45ed-8d82-a200d52f54f7&n=1'
@@ -1,142 +1,211 @@
-
-import os
 import time
-import random
-import subprocess
-import threading
+import asyncio
 import multiprocessing
-from uuid import uuid1
 from loguru import logger
-from playwright.sync_api import Page
+from playwright.async_api import TimeoutError as PlaywrightTimeoutError
 from headless_playwright import PlaywrightHandler
-from utils import api_request_to_pw_api, req_res_to_api_res, kill_pid
+from utils import api_request_to_pw_api, page_render_request_to_kwargs, req_res_to_api_res, StageTimer
 
 from pipe import ChildPipe, create_process_pipe
-from models import APIRequestModel, APIResponseModel, PlaywrightAPI
+from models import APIRequestModel, APIResponseModel, PageRenderRequestModel
+from exception import InternalException, TimeoutException
+from blocklist import DomainBlocklist
+from resource_cache import ResourceCache
+from proxy_bridge import ProxyBridge, need_bridge
+from shm import write_content, write_bytes
+from compression import compress
+from env import (BLOCKLIST_PATH, RESOURCE_CACHE_DIR, RESOURCE_CACHE_MAX_MB, RESOURCE_CACHE_MAX_ITEM_MB, PROXY_BACKEND,
+                 MAX_SPARE_CONTEXTS, STEALTH_PROFILE)
 
 
 class Worker:
-    def __init__(self, c_pipe: ChildPipe, port=None):
+    def __init__(self, c_pipe: ChildPipe, max_pages=1, prewarm=False):
         self.c_pipe = c_pipe
         self.session_id = None
-        self.pw: PlaywrightHandler = PlaywrightHandler()
-        self.page: Page = None
-        self.sock_pipe = None
-        self.port = port
-        self.proxy_url = None
-
-    def destroy(self):
+        # 黑名单在子进程中加载一次，所有任务共用；子资源缓存目录所有子进程共用
+        resource_cache = None
+        if RESOURCE_CACHE_DIR:
+            resource_cache = ResourceCache(RESOURCE_CACHE_DIR,
+                                           max_bytes=RESOURCE_CACHE_MAX_MB * 1024 * 1024,
+                                           max_item_bytes=RESOURCE_CACHE_MAX_ITEM_MB * 1024 * 1024)
+        # gost 转发由主进程管理，关闭后本地地址失效，不为带代理的context预热
+        self.pw: PlaywrightHandler = PlaywrightHandler(blocklist=DomainBlocklist.load(BLOCKLIST_PATH),
+                                                       resource_cache=resource_cache,
+                                                       max_spare_pages=MAX_SPARE_CONTEXTS,
+                                                       spare_proxy=PROXY_BACKEND != 'gost',
+                                                       stealth_profile=STEALTH_PROFILE)
+        # 带认证的代理在子进程内转发，不再依赖gost
+        self.proxy_bridge = ProxyBridge() if PROXY_BACKEND == 'bridge' else None
+        self.max_pages = max_pages  # 一个浏览器同时执行的任务数，每个任务使用独立的context
+        self.prewarm = prewarm  # 是否预热默认页面
+        self.stop_event: asyncio.Event = None
+        self.page_semaphore: asyncio.Semaphore = None
+        self.running_tasks = set()
+
+    async def destroy(self):
         """
         清理浏览器资源
         """
         if self.pw:
-            self.pw.close_page(self.page)
-            self.pw.close_context()
-            self.pw.close_browser()
+            await self.pw.close_browser()
 
-        self.destroy_sock_pipe()
+        if self.proxy_bridge:
+            await self.proxy_bridge.close()
 
-    def send_message(self, res_msg: APIResponseModel):
+    def send_message(self, request_id: str, res_msg: APIResponseModel, meta: dict = None):
+        """
+        往管道中发送信息，附带 request_id 供主进程匹配请求
+        meta 中记录各阶段耗时以及发送时间，用于统计
         """
-        往管道中发送信息
+        meta = meta or dict()
+        if isinstance(res_msg, APIResponseModel) and res_msg._body is not None:
+            desc = write_bytes(res_msg._body)
+            if desc:
+                res_msg._body = None
+                meta['shm'] = dict(desc, field='body')
+        elif isinstance(res_msg, APIResponseModel):
+            # 较大的页面内容写入共享内存，避免在管道中序列化复制
+            desc = write_content(res_msg.content)
+            if desc:
+                res_msg.content = None
+                meta['shm'] = desc
+        meta['sent_at'] = time.time()
+        self.c_pipe.send((request_id, res_msg, meta))
+
+    async def execute(self, req: APIRequestModel, timer: StageTimer = None, meta: dict = None) -> APIResponseModel:
+        """
+        执行接收过来的信息
+        代理为gost时已由主进程转换为本地转发地址；为bridge时带认证的代理在子进程内转发
+        代理地址设置到任务的context，不同任务可以同时使用不同的代理
+        meta 中记录黑名单拦截等统计信息
+        离线渲染请求直接渲染传入的html，不使用代理
         """
-        self.c_pipe.send(res_msg)
 
-    def subprocess_sock_pipe(self, local_port, sock_url):
-        subprocess_cmd = f"gost -L :{local_port} -F {sock_url}"
-        logger.info(subprocess_cmd)
-        process = subprocess.Popen(subprocess_cmd.split())
-        logger.info(f"子进程gost sock5转发启动。pid: {process.pid}")
-        time.sleep(1)
+        logger.info('子进程开始执行请求任务。')
+        timer = timer or StageTimer()
+
+        upstream = None
+        try:
+            if isinstance(req, PageRenderRequestModel):
+                req_data = await self.pw.render_content(timer=timer, **page_render_request_to_kwargs(req))
+            else:
+                pw_api = api_request_to_pw_api(req)
+                if self.proxy_bridge and pw_api.proxy and need_bridge(pw_api.proxy):
+                    upstream = pw_api.proxy
+                    pw_api.proxy = await self.proxy_bridge.acquire(upstream)
+                    timer.lap('proxy_setup')
+
+                req_data = await self.pw.goto_the_url(timer=timer, **dict(pw_api))
+            api_res = req_res_to_api_res(req_data)
+            if req_data.get('blocked') and meta is not None:
+                meta['blocked'] = req_data['blocked']
+                logger.info(f"拦截黑名单请求: {req_data['blocked']['count']}, "
+                            f"估算节省流量: {req_data['blocked']['bytes_saved']} bytes")
+            if req_data.get('resource_cache') and meta is not None:
+                meta['resource_cache'] = req_data['resource_cache']
+                logger.info(f"子资源缓存命中: {req_data['resource_cache']['hits']}, "
+                            f"未命中: {req_data['resource_cache']['misses']}, "
+                            f"节省流量: {req_data['resource_cache']['bytes_saved']} bytes")
+            if req_data.get('settle') and meta is not None:
+                meta['settle'] = req_data['settle']
+                logger.info(f"页面稳定等待: {req_data['settle']['waited']:.3f}s, "
+                            f"节省: {req_data['settle']['saved']:.3f}s")
+        except PlaywrightTimeoutError as e:
+            logger.exception(e)
+            api_res = TimeoutException(str(e))
+        except Exception as e:
+            logger.exception(e)
+            api_res = InternalException(str(e))
+        finally:
+            if upstream:
+                self.proxy_bridge.release(upstream)
+
+        if self.proxy_bridge and meta is not None:
+            proxy_stats = self.proxy_bridge.pop_stats()
+            if proxy_stats:
+                meta['proxy'] = proxy_stats
 
-        return process
+        logger.info('子进程任务执行完成。')
 
-    def create_sock_pipe(self, sock_url):
+        return api_res
+
+    async def handle_message(self, request_id: str, data: APIRequestModel, dispatched_at: float):
+        received_at = time.time()
+        timer = StageTimer()
+        timer.timings['dispatch'] = max(received_at - dispatched_at, 0)
+        meta = {'timings': timer.timings}
+        async with self.page_semaphore:
+            timer.lap('page_slot')
+            api_res = await self.execute(data, timer=timer, meta=meta)
+        if isinstance(api_res, APIResponseModel) and data._content_encoding:
+            # 在子进程中压缩，主进程不持有未压缩的页面内容
+            content = (api_res.content or '').encode('utf-8')
+            api_res._body = await asyncio.to_thread(compress, content, data._content_encoding)
+            api_res.content = None
+            timer.lap('compress')
+        self.send_message(request_id, api_res, meta)
+
+    async def evict_idle_proxy(self):
         """
-        创建sock5转发管道
+        定时关闭空闲的代理转发
         """
-        if not self.port:
-            self.port = random.randint(20000, 30000)
-
-        self.sock_pipe = self.subprocess_sock_pipe(self.port, sock_url)
-        self.proxy_url = sock_url
-
-    def destroy_sock_pipe(self):
-        if self.sock_pipe:
+        while True:
+            await asyncio.sleep(10)
             try:
-                pid = self.sock_pipe.pid
-                self.sock_pipe.send_signal(9)
-                self.sock_pipe.wait(timeout=1)
-                kill_pid(pid)
-                logger.info(f"子进程gost sock5转发关闭。pid: {self.sock_pipe.pid}")
+                for proxy_server in await self.proxy_bridge.evict_idle():
+                    await self.pw.discard_spare_pages(proxy_server)
             except Exception as e:
-                logger.error(f"子进程gost sock5转发关闭失败。pid: {self.sock_pipe.pid}")
-    
-    def update_sock_pipe(self, sock_url):
-        if not sock_url:
-            return
-        
-        if sock_url != self.proxy_url:
-            self.destroy_sock_pipe()
-            self.create_sock_pipe(sock_url)
-            logger.info(f"gost 更新，新sock5代理：{sock_url}")
-            
-    def execute(self, req: APIRequestModel) -> APIResponseModel:
-        """
-        执行接收过来的信息
-        """
-
-        logger.info('子进程开始执行请求任务。')
-        pw_api = api_request_to_pw_api(req)
-
-        if pw_api.proxy and not self.sock_pipe:
-            self.create_sock_pipe(pw_api.proxy)
-        elif pw_api.proxy and self.sock_pipe and pw_api.proxy != self.proxy_url:
-            self.update_sock_pipe(pw_api.proxy)
-        
-        if pw_api.proxy:
-            pw_api.proxy = f'http://127.0.0.1:{self.port}'
-
-        if not self.pw:
-            self.pw = PlaywrightHandler()
-
-        req_data = self.pw.goto_the_url(page=self.page, **dict(pw_api))
-        self.page = self.pw.page
-        api_res = req_res_to_api_res(req_data)
-        self.send_message(api_res)
-        logger.info('子进程任务执行完成。')
+                logger.exception(e)
 
-    def worker_watch_dog(self):
+    def on_pipe_message(self):
         """
-        检测conn管道信息
+        事件循环回调，检测conn管道信息
         """
         while True:
-            data: APIRequestModel = self.c_pipe.recv()
-            if data is None:
-                continue
+            message = self.c_pipe.recv()
+            if message is None:
+                return
 
-            if data == 'kill':
-                self.destroy()
-                break
+            if message == 'kill':
+                self.stop_event.set()
+                return
 
+            request_id, data, dispatched_at = message
             logger.info('子进程获取到请求任务。')
-            self.execute(data)
+            task = asyncio.create_task(self.handle_message(request_id, data, dispatched_at))
+            self.running_tasks.add(task)
+            task.add_done_callback(self.running_tasks.discard)
 
-    def watch_dog(self):
-        t = threading.Thread(target=self.worker_watch_dog)
-        t.start()
+    async def worker_watch_dog(self):
+        """
+        启动浏览器，并在事件循环中检测conn管道信息
+        """
+        self.stop_event = asyncio.Event()
+        self.page_semaphore = asyncio.Semaphore(self.max_pages)
+        await self.pw.start(prewarm=self.prewarm)
+
+        loop = asyncio.get_running_loop()
+        loop.add_reader(self.c_pipe.fileno(), self.on_pipe_message)
+        evict_task = asyncio.create_task(self.evict_idle_proxy()) if self.proxy_bridge else None
+        # 通知主进程可以分配任务
+        self.c_pipe.send('ready')
         logger.info('子进程开始监测管道信息。')
-
-    def __del__(self):
-        self.destroy()
-
-
-def create_worker(c_pipe: ChildPipe, port=None):
+        try:
+            await self.stop_event.wait()
+        finally:
+            loop.remove_reader(self.c_pipe.fileno())
+            if evict_task:
+                evict_task.cancel()
+            for task in list(self.running_tasks):
+                task.cancel()
+            await self.destroy()
+
+
+def create_worker(c_pipe: ChildPipe, max_pages=1, prewarm=False):
     # create one worker
 
-    worker = Worker(c_pipe=c_pipe, port=port)
-    # worker.watch_dog()
-    worker.worker_watch_dog()
+    worker = Worker(c_pipe=c_pipe, max_pages=max_pages, prewarm=prewarm)
+    asyncio.run(worker.worker_watch_dog())
 
     return worker
 
@@ -152,12 +221,12 @@ def worker_test():
     task = multiprocessing.Process(target=create_worker, args=(c_pipe,))
     task.start()
 
-    p_pipe.send(api_res)
+    p_pipe.send(('test', api_res, time.time()))
     while True:
         data = p_pipe.recv()
-        if data is not None:
+        if data is not None and data != 'ready':
             break
-    print(data)
+    print(data[1], data[2])
 
     p_pipe.send('kill')
 